@@ -0,0 +1,844 @@
+""" Rough benchmarks for catprint.py, from decoding and rendering to bytes arriving at a (simulated) printer.
+    Run as  python bench.py  for all of them, or name some (e.g. python bench.py pipeline end_to_end).
+    --json FILE also writes the numbers there, tagged with the git commit, so that runs can be compared across commits.
+"""
+import sys, os, time, json, asyncio, argparse, functools, subprocess, platform, tracemalloc, io, concurrent.futures, tempfile, shutil, collections, importlib.util, urllib.request
+try:
+    import resource # not on windows
+except ImportError:
+    resource = None
+
+import PIL.Image
+import PIL.ImageDraw
+import PIL.ImageFont
+
+import catprint
+
+
+def legacy_crc8(data):
+    ' The old crc8, which built its table as a list on every call '
+    crc8_table = list(catprint.Crc8Table)
+    crc = 0
+    for byte in data:
+        crc = crc8_table[(crc ^ byte) & 0xFF]
+    return crc & 0xFF
+
+
+def legacy_format_message(command, data):
+    ' The old list-concatenating format_message '
+    data = [ 0x51, 0x78 ] + [command] + [0x00] + [len(data)] + [0x00] + data + [legacy_crc8(data)] + [0xFF]
+    return bytes(data)
+
+
+def legacy_image_to_drawcommands(pil_or_bytes, feed_amount=0, energy=0x7EE0):
+    ' The old per-pixel, per-message encoder, kept here to check the current one against, and to time it '
+    cmdqueue = []
+    cmdqueue += legacy_format_message(catprint.GetDevState, [0x00])
+    cmdqueue += legacy_format_message(catprint.SetQuality,  [0x33])
+    cmdqueue += legacy_format_message(catprint.ControlLattice, catprint.PrintLattice)
+    cmdqueue += legacy_format_message(catprint.SetEnergy,   [energy.to_bytes(2, 'little')[0], energy.to_bytes(2, 'little')[1]])
+    cmdqueue += legacy_format_message(catprint.DrawingMode, [0])
+    cmdqueue += legacy_format_message(catprint.OtherFeedPaper, catprint.ImgPrintSpeed)
+
+    if pil_or_bytes:
+        pil_image = catprint.prepare_image( pil_or_bytes ).rotate(180)
+        for y in range(0, pil_image.height):
+            bmp = []
+            bit = 0
+            for x in range(0, pil_image.width):
+                if bit % 8 == 0:
+                    bmp += [0x00]
+                bmp[int(bit / 8)] >>= 1
+                if not pil_image.getpixel((x, y)):
+                    bmp[int(bit / 8)] |= 0x80
+                bit += 1
+            cmdqueue += legacy_format_message(catprint.DrawBitmap, bmp)
+
+    cmdqueue += legacy_format_message(catprint.OtherFeedPaper, catprint.BlankSpeed)
+    if feed_amount > 0:
+        cmdqueue += legacy_format_message(catprint.FeedPaper,    [feed_amount.to_bytes(2, 'little')[0], feed_amount.to_bytes(2, 'little')[1]])
+    else:
+        feed_amount = abs(feed_amount)
+        cmdqueue += legacy_format_message(catprint.RetractPaper, [feed_amount.to_bytes(2, 'little')[0], feed_amount.to_bytes(2, 'little')[1]])
+    cmdqueue += legacy_format_message(catprint.ControlLattice, catprint.FinishLattice)
+    return cmdqueue
+
+
+def legacy_decode(data, rotate='no'):
+    ' The old decode: full size, always pasted on an RGBA canvas, rotated before scaling down '
+    image = PIL.Image.open(io.BytesIO(data))
+    new_image = PIL.Image.new("RGBA", image.size, "WHITE")
+    new_image.paste(image, (0, 0), image  if image.mode in ('RGBA', 'LA')  else  None)
+    image = new_image
+    if rotate == 'yes'  or  (rotate == 'long' and image.width > image.height):
+        image = image.rotate(90, expand=True)
+    return image
+
+
+def legacy_generate_text_image(text, font_name="FreeSans.ttf", font_size=30):
+    ' The old text renderer: font loaded each time, quadratic wrapping, huge canvas trimmed afterwards '
+    def get_wrapped_text(text, font, line_length):
+        if font.getlength(text) <= line_length:
+            return text
+        lines = ['']
+        for word in text.split():
+            line = f'{lines[-1]} {word}'.strip()
+            if font.getlength(line) <= line_length:
+                lines[-1] = line
+            else:
+                lines.append(word)
+        return '\n'.join(lines)
+    img = PIL.Image.new('RGB', (catprint.PrinterWidth, 5000), color = (255, 255, 255))
+    font = PIL.ImageFont.truetype(font_name, font_size)
+    d = PIL.ImageDraw.Draw(img)
+    lines = "\n".join( get_wrapped_text(line, font, catprint.PrinterWidth)  for line in text.splitlines() )
+    d.text((0,0), lines, fill=(0,0,0), font=font)
+    return catprint.trim_image(img)
+
+
+short_alert = 'Backup failed on host db-2 at 03:12'
+long_text   = '\n'.join(['Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. '*3]*4)
+
+
+def tall_image(height):
+    ' something with a bit of everything: gradients (so dithering does something), text, lines '
+    im = PIL.Image.new('L', (catprint.PrinterWidth, height), 255)
+    d = PIL.ImageDraw.Draw(im)
+    for y in range(0, height, 7):
+        d.line((0, y, catprint.PrinterWidth, (y*3)%height), fill=(y*5)%256)
+    for y in range(0, height, 40):
+        d.text((10, y), 'line %d of a tall banner'%y, fill=0)
+    return im
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    ' returns (best time in seconds, last result) '
+    best, ret = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        ret = func(*args, **kwargs)
+        took = time.perf_counter() - t0
+        if best is None or took < best:
+            best = took
+    return best, ret
+
+
+def bench_framing(rowcount=3000):
+    print('framing %d DrawBitmap rows'%rowcount)
+    rows = bytes( (i*7)&0xFF  for i in range(rowcount*catprint.RowBytes) )
+    def per_row_legacy():
+        cmdqueue = []
+        for y in range(0, len(rows), catprint.RowBytes):
+            cmdqueue += legacy_format_message(catprint.DrawBitmap, list(rows[y:y+catprint.RowBytes]))
+        return cmdqueue
+    def per_row():
+        cmdqueue = bytearray()
+        for y in range(0, len(rows), catprint.RowBytes):
+            cmdqueue += catprint.format_message(catprint.DrawBitmap, rows[y:y+catprint.RowBytes])
+        return cmdqueue
+    t_legacy, legacy = timed(per_row_legacy)
+    t_row,    row    = timed(per_row)
+    t_batch,  batch  = timed(catprint.format_messages, catprint.DrawBitmap, rows, catprint.RowBytes)
+    assert bytes(legacy) == bytes(row) == bytes(batch), 'framing differs'
+    print('  old format_message %7.1f ms   format_message %7.1f ms   format_messages %6.1f ms  (%d bytes, identical)'%(
+        1000*t_legacy, 1000*t_row, 1000*t_batch, len(batch)))
+    return {'rows':rowcount, 'bytes':len(batch), 'legacy_sec':t_legacy, 'format_message_sec':t_row, 'format_messages_sec':t_batch}
+
+
+def bench_encoder(heights=(100, 1000, 3000)):
+    print('image_to_drawcommands, %d wide'%catprint.PrinterWidth)
+    ret = {}
+    for height in heights:
+        im = tall_image(height)
+        t_old, old = timed(legacy_image_to_drawcommands, im, repeat=1)
+        t_new, new = timed(catprint.image_to_drawcommands, im, collapse_blank=False)
+        assert bytes(old) == bytes(new), 'encoder output differs from the per-pixel version at height %d'%height
+        print('  %5d rows:  per-pixel %8.1f ms   bulk %7.1f ms   (%5.1fx, %d bytes, identical)'%(
+            height, 1000*t_old, 1000*t_new, t_old/t_new, len(new)))
+        ret['%d rows'%height] = {'bytes':len(new), 'legacy_sec':t_old, 'sec':t_new}
+    return ret
+
+
+def notification_image():
+    ' a few short lines of text with a lot of white in between, like most notifications '
+    im = PIL.Image.new('L', (catprint.PrinterWidth, 600), 255)
+    d = PIL.ImageDraw.Draw(im)
+    for i, y in enumerate(range(10, 600, 90)):
+        d.text((10, y), 'notification line %d'%i, fill=0)
+    return im
+
+
+def bench_blank_collapsing():
+    print('bytes on air for a mostly-white notification print')
+    im = notification_image()
+    plain = catprint.image_to_drawcommands(im, collapse_blank=False)
+    ret = {'plain_bytes':len(plain)}
+    for model in (None, catprint.compressed_bitmap_printer_names[0]):
+        t, collapsed = timed(catprint.image_to_drawcommands, im, collapse_blank=True, model=model)
+        print('  per-row %6d bytes   blank rows fed (%s) %6d bytes  (%.1f%%, %.1f ms)'%(
+            len(plain), 'compressed rows' if model else 'plain rows', len(collapsed), 100.*len(collapsed)/len(plain), 1000*t))
+        ret['compressed_bytes' if model else 'collapsed_bytes'] = len(collapsed)
+    return ret
+
+
+def bench_streaming(heights=(1000, 10000, 30000)):
+    print('streaming the command stream in %d-byte packets, vs. encoding all of it first'%catprint.packet_length)
+    ret = {}
+    for height in heights:
+        im = catprint.prepare_image( tall_image(height) ) # so the timings below don't include dithering
+
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        whole = catprint.image_to_drawcommands(im)
+        t_whole = time.perf_counter() - t0
+        whole_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        t_first, sent, streamed = None, 0, bytearray()
+        for packet in catprint.iter_drawcommands(im):
+            if t_first is None:
+                t_first = time.perf_counter() - t0
+            sent += len(packet)
+            if height == heights[0]:
+                streamed += packet
+        t_stream = time.perf_counter() - t0
+        stream_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        assert sent == len(whole)
+        if height == heights[0]:
+            assert streamed == whole, 'streamed commands differ'
+        print('  %5d rows:  whole %6.1f ms, peak %7.0f kB     streamed %6.1f ms, first packet after %5.2f ms, peak %5.0f kB'%(
+            height, 1000*t_whole, whole_peak/1024., 1000*t_stream, 1000*t_first, stream_peak/1024.))
+        ret['%d rows'%height] = {'bytes':sent, 'whole_sec':t_whole, 'whole_peak_bytes':whole_peak,
+                                 'stream_sec':t_stream, 'first_packet_sec':t_first, 'stream_peak_bytes':stream_peak}
+    return ret
+
+
+def bench_text_rendering():
+    print('generate_text_image')
+    ret = {}
+    for name, text, font_size in (('short alert', short_alert, 30), ('long text', long_text, 30), ('long text, small', long_text, 20)):
+        t_old, old = timed(legacy_generate_text_image, text, font_size=font_size, repeat=5)
+        t_new, new = timed(catprint.generate_text_image, text, font_size=font_size, repeat=5)
+        print('  %-18s old %6.2f ms %s   new %6.2f ms %s  (%4.1fx)'%(name, 1000*t_old, '%dx%d'%old.size, 1000*t_new, '%dx%d'%new.size, t_old/t_new))
+        ret[name] = {'legacy_sec':t_old, 'sec':t_new, 'size':new.size}
+    # as high as trimming used to make it, which goes by the ink, not the font's boxes
+    # (accents reaching above the first line make it higher: drawing at the top of the image used to cut those off)
+    for text in ('_', '-', '...', 'a\n_', 'x\n\n-'):
+        assert catprint.generate_text_image(text, font_size=16).height == legacy_generate_text_image(text, font_size=16).height, repr(text)
+    return ret
+
+
+receipt_lines = ['CORNER SHOP', 'Till 3   2024-05-01 17:42', ''] + [ '%-24s %6.2f'%('item number %d'%i, 1.25*i)  for i in range(1, 30) ] + ['', '%-24s %6.2f'%('TOTAL', 543.75)]
+
+def receipt_image():
+    ' a till receipt: 384 wide already, small text, lots of white '
+    im = PIL.Image.new('L', (catprint.PrinterWidth, 20*len(receipt_lines)+20), 255)
+    d = PIL.ImageDraw.Draw(im)
+    font = PIL.ImageFont.truetype('FreeSans.ttf', 16)
+    for i, line in enumerate(receipt_lines):
+        d.text((8, 10+20*i), line, fill=0, font=font)
+    return png_bytes(im)
+
+
+def png_bytes(im):
+    out = io.BytesIO()
+    im.save(out, 'PNG')
+    return out.getvalue()
+
+
+@functools.lru_cache()
+def phone_photo(size=(4032, 3024)):
+    ' what a phone camera gives you: a 12 megapixel JPEG.  Smooth gradients plus noise, so it compresses (and dithers) like a photo '
+    w, h = size
+    channels = [ PIL.Image.radial_gradient('L').resize(size),
+                 PIL.Image.linear_gradient('L').resize(size),
+                 PIL.Image.effect_noise(size, 40) ]
+    im = PIL.Image.merge('RGB', channels)
+    out = io.BytesIO()
+    im.save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+def pipeline_fixtures():
+    ' (name, kind, data, option) of jobs as the web API would queue them '
+    return [
+        ('short alert',  'text',  short_alert, 30),
+        ('long text',    'text',  long_text, 30),
+        ('receipt',      'image', receipt_image(), catprint.ImageOptions()),
+        ('phone photo',  'image', phone_photo(), catprint.ImageOptions()),
+        ('tall banner',  'image', png_bytes(tall_image(20000)), catprint.ImageOptions()),
+    ]
+
+
+def run_pipeline(kind, data, option):
+    """ what happens to a job, stage by stage (prepare_job does the first three in one go, the printer loop the last).
+        Returns ({stage:seconds}, encoded bytes)
+    """
+    times = {}
+    t0 = time.perf_counter()
+    if kind == 'text':
+        image = catprint.generate_text_image(data, font_size=option)
+        times['render'] = time.perf_counter() - t0
+    else:
+        image = catprint.decode_image(data, option.rotate)
+        times['decode'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    prepared = catprint.prepare_image(image)
+    times['prepare'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    encoded = b''.join( catprint.drawcommand_bands(prepared, energy=catprint.job_energy(kind)) )
+    times['encode'] = time.perf_counter() - t0
+    return times, encoded
+
+
+def bench_pipeline(repeat=3):
+    print('per-stage time, bytes produced, and peak memory per job')
+    ret = {}
+    for name, kind, data, option in pipeline_fixtures():
+        best = None
+        for _ in range(repeat):
+            times, encoded = run_pipeline(kind, data, option)
+            best = times  if best is None  else  { stage:min(t, best[stage])  for stage, t in times.items() }
+        tracemalloc.start() # separately, it slows things down.  (It only sees python's allocations, not PIL's own image memory)
+        run_pipeline(kind, data, option)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('  %-12s %s   total %7.1f ms   %7d bytes input, %7d bytes of commands   python peak %7.0f kB'%(
+            name, '  '.join( '%s %6.1f ms'%(stage, 1000*t)  for stage, t in best.items() ), 1000*sum(best.values()),
+            len(data), len(encoded), peak/1024.))
+        ret[name] = {'stage_sec':best, 'total_sec':sum(best.values()), 'input_bytes':len(data), 'command_bytes':len(encoded), 'python_peak_bytes':peak}
+    return ret
+
+
+class CountingPrinter(catprint.Printer):
+    ' a Printer that counts the command_queue entries it finished sending, so we know when a batch of jobs is done, and the status round trips in between '
+    sent_entries  = 0
+    status_checks = 0
+    streaming    = False
+    turn         = None   # when the first StreamedPrint started going out
+
+    async def send_commands(self, *args, **kwargs):
+        ret = await super().send_commands(*args, **kwargs)
+        if not self.streaming: # a StreamedPrint sends each band this way, but counts as one entry
+            self.sent_entries += 1
+        return ret
+
+    async def request_status(self):
+        self.status_checks += 1
+        return await super().request_status()
+
+    async def send_streamed(self, *args, **kwargs):
+        if self.turn is None:
+            self.turn = time.perf_counter()
+        self.streaming = True
+        try:
+            done = await super().send_streamed(*args, **kwargs)
+        finally:
+            self.streaming = False
+        if done:
+            self.sent_entries += 1
+        return done
+
+
+async def print_through_scheduler(jobs, sessions=None, printer_class=catprint.SimulatedPrinter, entries=None, **printer_options):
+    """ Submits jobs to the real job queue and printer loop, talking to a catprint.SimulatedPrinter (or printer_class),
+        and waits until the last of them was sent - which is after sessions print sessions (default: one per job),
+        or after that many command_queue entries went out (a compiled directory is one per file).
+        Returns (seconds, the SimulatedPrinter, the Printer).  printer.started is when the jobs were submitted
+    """
+    took, simulated, printers = await print_through_pool(jobs, 1, sessions, printer_class, entries, **printer_options)
+    return took, simulated[0], printers[0]
+
+
+async def print_through_pool(jobs, count, sessions=None, printer_class=catprint.SimulatedPrinter, entries=None, **printer_options):
+    ' print_through_scheduler, with count printers sharing the job queue.  Returns (seconds, [SimulatedPrinter], [Printer]) '
+    simulated = [ printer_class(address='00:00:00:00:00:%02X'%(i+1), **printer_options)  for i in range(count) ]
+    printers = [ CountingPrinter(transport=transport)  for transport in simulated ]
+    catprint.printers[:] = printers
+    loop_task = asyncio.get_running_loop().create_task( catprint.connect_catprinters_and_handle_queues() )
+    while not all( printer.connected  for printer in printers ):
+        await asyncio.sleep(0.01)
+
+    t0 = time.perf_counter()
+    for printer in printers:
+        printer.started = t0
+    for job in jobs:
+        catprint.job_queue.submit(job)
+    while sum( printer.sent_entries  for printer in printers ) < (entries or 3*(sessions or len(jobs))): # each is a feed, the image, and a feed
+        await asyncio.sleep(0.001)
+    took = time.perf_counter() - t0
+
+    loop_task.cancel()
+    try:
+        await loop_task
+    except asyncio.CancelledError:
+        pass
+    catprint.printers[:] = []
+    return took, simulated, printers
+
+
+def bench_end_to_end(count=20):
+    print('end to end: %d jobs through the job queue and printer loop, to a simulated printer (job cache off)'%count)
+    stand_ins = ( # name, SimulatedPrinter options
+        ('instant link', dict(bandwidth=1e9, latency=0, paper_speed=1e9, flow_control=False)),
+        ('ble-ish link', dict(bandwidth=20000, latency=0.01, paper_speed=1e9, flow_control=False)),
+    )
+    alerts = [ ('text', '%s (%d)'%(short_alert, i), 30)  for i in range(count) ]
+    job_mixes = ( # name, jobs, how many of them get printed together (see catprint.coalesce_jobs)
+        ('short alerts', alerts, 1),
+        ('  coalesced',  alerts, count),
+        ('  as a batch', [ catprint.batch_of(alerts) ], 1),
+        ('receipts',     [ ('image', receipt_image(), catprint.ImageOptions()) ] * count, 1),
+    )
+    ret = {}
+    cache_bytes, catprint.job_cache.max_bytes = catprint.job_cache.max_bytes, 0
+    coalesce_jobs = catprint.coalesce_jobs
+    try:
+        for link, options in stand_ins:
+            for mix, jobs, coalesce in job_mixes:
+                catprint.coalesce_jobs = coalesce
+                took, simulated, printer = asyncio.run( print_through_scheduler(jobs, sessions=-(-len(jobs)//coalesce), **options) )
+                assert simulated.stats['bad_messages'] == 0
+                printed = sum( len(job[1])  if job[0] == 'batch'  else  1   for job in jobs )
+                print('  %-12s %-12s %6.2f jobs/sec   %7.0f bytes/sec   %6d writes   %4d status requests'%(
+                    link, mix, printed/took, printer.transfer_stats['bytes']/took, simulated.stats['writes'], simulated.stats['command_A3']))
+                ret['%s, %s'%(link, mix.strip())] = {'jobs':printed, 'sec':took, 'jobs_per_sec':printed/took, 'bytes':printer.transfer_stats['bytes'], 
+                                                     'writes':simulated.stats['writes'], 'status_requests':simulated.stats['command_A3']}
+    finally:
+        catprint.job_cache.max_bytes = cache_bytes
+        catprint.coalesce_jobs = coalesce_jobs
+    return ret
+
+
+def bench_printer_pool(count=12, sizes=(1, 2, 3)):
+    print('end to end: %d short alerts through the job queue, shared by 1 and more simulated printers (job cache off)'%count)
+    link = dict(bandwidth=20000, latency=0.01, paper_speed=1e9, flow_control=False)
+    jobs = [ ('text', '%s (%d)'%(short_alert, i), 30)  for i in range(count) ]
+    ret = {}
+    cache_bytes, catprint.job_cache.max_bytes = catprint.job_cache.max_bytes, 0
+    try:
+        for size in sizes:
+            took, simulated, printers = asyncio.run( print_through_pool(jobs, size, **link) )
+            assert all( transport.stats['bad_messages'] == 0  for transport in simulated )
+            done = [ printer.jobs_done  for printer in printers ]
+            assert sum(done) == count  and  min(done) > 0, 'jobs not spread across the printers: %s'%done
+            if size > 1:
+                alone = ret['1 printer']['sec']
+                assert took < 1.5 * alone / size, '%d printers took %.2f sec, against %.2f sec for one'%(size, took, alone)
+            print('  %d printer%s  %6.2f sec   %5.2f jobs/sec   %4.1fx one printer   jobs each: %s'%(
+                size, ' ' if size == 1 else 's', took, count/took, ret['1 printer']['sec']/took  if size > 1  else 1, ', '.join(map(str, done))))
+            ret['%d printer%s'%(size, '' if size == 1 else 's')] = {'sec':took, 'jobs_per_sec':count/took, 'jobs_per_printer':done}
+    finally:
+        catprint.job_cache.max_bytes = cache_bytes
+    return ret
+
+
+class WatchedPrinter(catprint.SimulatedPrinter):
+    """ A SimulatedPrinter that notes when the first row arrived, and the longest it went without a status request while rows came in.
+        With out_of_paper_after, it says it is out of paper once it got that many rows, until paper_refill seconds later.
+        Without answers_while_printing, it ignores status requests between starting and finishing the lattice, as some models may.
+        It only counts the rows rather than keeping them, so that memory use is that of the sending side.
+    """
+    def __init__(self, out_of_paper_after=None, paper_refill=0.5, answers_while_printing=True, **options):
+        super().__init__(**options)
+        self.out_of_paper_after = out_of_paper_after
+        self.paper_refill       = paper_refill
+        self.answers_while_printing = answers_while_printing
+        self.in_lattice         = False
+        self.rows               = 0
+        self.rows_without_paper = 0
+        self.first_ink          = None
+        self.last_row           = None
+        self.last_status        = None
+        self.status_gap         = 0.0
+
+    def handle(self, command, data):
+        now = time.perf_counter()
+        if command == catprint.GetDevState:
+            if self.first_ink is not None:
+                self.status_gap = max(self.status_gap, now - self.last_status)
+            self.last_status = now
+        elif command in (catprint.DrawBitmap, catprint.DrawCompressedBitmap):
+            if self.first_ink is None:
+                self.first_ink = self.last_status = now
+            self.last_row = now
+        elif command == catprint.ControlLattice:
+            self.in_lattice = list(data) == catprint.PrintLattice
+        if command == catprint.GetDevState  and  self.in_lattice  and  not self.answers_while_printing:
+            self.stats['unanswered'] += 1
+            return
+        super().handle(command, data)
+
+    def longest_without_status(self):
+        ' the longest that rows kept coming without a status request in between '
+        return max(self.status_gap, self.last_row - self.last_status)
+
+    def feed(self, rows):
+        super().feed(rows)
+        del self.raster[:]
+        self.rows += len(rows) // catprint.RowBytes
+        if self.status_byte & 0x01:
+            self.rows_without_paper += len(rows) // catprint.RowBytes
+        elif self.out_of_paper_after is not None  and  self.rows >= self.out_of_paper_after:
+            self.out_of_paper_after = None
+            self.status_byte |= 0x01
+            asyncio.get_running_loop().call_later(self.paper_refill, self.refill)
+
+    def refill(self):
+        self.status_byte &= ~0x01
+
+
+def bench_strip_streaming(heights=(2000, 8000, 32000)):
+    print('tall images through the printer loop, to a simulated printer: as one entry, vs. a band at a time (catprint.stream_rows, pipelined, job cache off)')
+    print('  (first ink includes preparing the job, which decodes and dithers all of it;  streamed, it also says how long after the print got its turn)')
+    link = dict(bandwidth=1e6, latency=0.01, paper_speed=1e9, flow_control=False)
+    modes = (('whole', None), ('streamed', 1))
+    ret = {}
+    from_turn = []
+    cache_bytes, catprint.job_cache.max_bytes = catprint.job_cache.max_bytes, 0
+    stream_rows, transfer_mode, catprint.transfer_mode = catprint.stream_rows, catprint.transfer_mode, 'pipelined'
+    try:
+        for height in heights:
+            job = ('image', png_bytes(tall_image(height)), catprint.ImageOptions(dither='threshold'))
+            for mode, catprint.stream_rows in modes:
+                tracemalloc.start()
+                took, simulated, printer = asyncio.run( print_through_scheduler([job], printer_class=WatchedPrinter, **link) )
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                first_ink = simulated.first_ink - printer.started
+                print('  %6d rows  %-8s  first ink after %6.1f ms %s, all sent after %5.2f sec, at most %5.2f sec without a status request, python peak %6.0f kB'%(
+                    height, mode, 1000*first_ink, '(%5.1f after its turn)'%(1000*(simulated.first_ink - printer.turn))  if printer.turn  else ' '*20,
+                    took, simulated.longest_without_status(), peak/1024.))
+                ret['%d rows, %s'%(height, mode)] = {'first_ink_sec':first_ink, 'sec':took, 'status_gap_sec':simulated.longest_without_status(), 'python_peak_bytes':peak}
+                if printer.turn:
+                    from_turn.append(simulated.first_ink - printer.turn)
+                    ret['%d rows, %s'%(height, mode)]['first_ink_after_turn_sec'] = from_turn[-1]
+        assert max(from_turn) < 2*min(from_turn) + 0.02, 'streamed, the time to first ink grows with the height: %s'%from_turn
+
+        height = heights[len(heights)//2]
+        job = ('image', png_bytes(tall_image(height)), catprint.ImageOptions(dither='threshold'))
+        link.update(bandwidth=100000)
+        for mode, catprint.stream_rows in modes:
+            took, simulated, printer = asyncio.run( print_through_scheduler([job], printer_class=WatchedPrinter, out_of_paper_after=height//3, **link) )
+            print('  %6d rows  %-8s  out of paper a third of the way, for %.1f sec:  %5d rows sent meanwhile%s'%(
+                height, mode, simulated.paper_refill, simulated.rows_without_paper, ' (and sent again later)'  if catprint.stream_rows  else ''))
+            ret['%d rows, %s, out of paper'%(height, mode)] = {'sec':took, 'rows_without_paper':simulated.rows_without_paper}
+
+        catprint.stream_rows = 1
+        took, simulated, printer = asyncio.run( print_through_scheduler([job], printer_class=WatchedPrinter, answers_while_printing=False, **link) )
+        assert simulated.stats['unanswered'] > 0  and  not printer.band_checks # (and it got to the end, rather than waiting for answers)
+        print('  %6d rows  streamed  to a printer that does not answer while printing: all sent after %5.2f sec (catprint.band_status_timeout is %s)'%(
+            height, took, catprint.band_status_timeout))
+        ret['%d rows, streamed, no answers while printing'%height] = {'sec':took}
+    finally:
+        catprint.job_cache.max_bytes = cache_bytes
+        catprint.stream_rows = stream_rows
+        catprint.transfer_mode = transfer_mode
+    return ret
+
+
+def decode_and_prepare(decode, data, rotate):
+    ' runs in a fresh process (see bench_decode): returns (seconds, how much the peak resident memory grew, in bytes) '
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    catprint.prepare_image( decode(data, rotate) )
+    took = time.perf_counter() - t0
+    grew = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before
+    return took, grew * (1 if sys.platform == 'darwin' else 1024) # kilobytes, except on macOS
+
+
+def bench_decode():
+    print('decoding a phone photo and scaling it to the printer width, each in a fresh process to see its peak memory')
+    if resource is None:
+        print('  (needs the resource module, which this platform lacks)')
+        return {}
+    ret = {}
+    photo = phone_photo()
+    for rotate in ('no', 'yes'):
+        for name, decode in (('legacy', legacy_decode), ('decode_image', catprint.decode_image)):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                took, grew = pool.submit(decode_and_prepare, decode, photo, rotate).result()
+            print('  rotate %-4s %-14s %7.1f ms   peak memory +%6.1f MB'%(rotate, name, 1000*took, grew/1e6))
+            ret['rotate %s, %s'%(rotate, name)] = {'sec':took, 'peak_rss_growth_bytes':grew}
+    return ret
+
+
+def check_journal_replay(directory):
+    """ A journal as a crash leaves it: some jobs done, and the last record cut off halfway.
+        Asserts that opening it queues the jobs not done again, in order, as they were, without the torn record;
+        that the file then holds just those (opening it again gives the same);  and that it gets emptied once they are done.
+    """
+    path = os.path.join(directory, 'crashed.journal')
+    jobs = [ ('text', short_alert, 30),
+             ('image', png_bytes(notification_image()), catprint.ImageOptions(rotate='long', dither='atkinson', gamma=1.2)),
+             ('text', 'done before the crash', 20),
+             catprint.batch_of([ ('text', 'part one', 30), ('image', receipt_image(), catprint.ImageOptions()) ]) ]
+    queue = catprint.JobQueue(10)
+    queue.open_journal(path)
+    ids = [ queue.submit(job, catprint.job_priorities['normal'], printer)  for job, printer in zip(jobs, (None, 'MX06', None, None)) ]
+    queue.done(ids[2])
+    record = io.BytesIO()
+    queue.journal.write_accepted(record, ids[-1]+1, ('text', 'torn', 30), catprint.job_priorities['normal'], None)
+    queue.journal.close()
+    with open(path, 'ab') as f:
+        f.write( record.getvalue()[:len(record.getvalue())//2] )
+    crashed = os.path.getsize(path)
+
+    pending = [ (ids[i], jobs[i])  for i in (0, 1, 3) ]
+    replayed = None
+    for _ in range(2): # (the second time from the file as the first rewrote it)
+        if replayed is not None:
+            replayed.journal.close()
+        replayed = catprint.JobQueue(10)
+        replayed.open_journal(path)
+        popped = [ replayed.pop()  for _ in range(len(replayed)) ]
+        assert [ (job_id, job)  for job, _, job_id in popped ] == pending, 'replayed jobs differ'
+        assert os.path.getsize(path) < crashed, 'journal was not rewritten'
+    replayed.done( *[ job_id  for job_id, _ in pending ] )
+    replayed.journal.close()
+    assert os.path.getsize(path) == len(catprint.JobJournal.magic), 'journal was not emptied once all was done'
+
+
+def bench_journal(count=1000):
+    print('submitting %d short alerts: in memory only, and through a JobJournal (in the current directory), from 1 and more threads'%count)
+    directory = tempfile.mkdtemp(dir='.')
+    try:
+        check_journal_replay(directory)
+    finally:
+        shutil.rmtree(directory)
+    print('  (replaying a crashed journal, with a torn last record: checked)')
+    ret = {}
+    for name, journaled, threads in (('memory only', False, 1), ('journal, 1 submitter', True, 1), 
+                                     ('journal, 8 submitters', True, 8), ('journal, 32 submitters', True, 32)):
+        directory = tempfile.mkdtemp(dir='.')
+        try:
+            path = os.path.join(directory, 'jobs.journal')
+            queue = catprint.JobQueue(count)
+            if journaled:
+                queue.open_journal(path)
+            t0 = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+                list( pool.map(lambda _: queue.submit( ('text', short_alert, 30) ), range(count)) )
+            took = time.perf_counter() - t0
+            ret[name] = {'sec':took, 'jobs_per_sec':count/took}
+            line = '  %-24s %8.0f jobs/s'%(name, count/took)
+            if journaled:
+                queue.journal.close()
+                t0 = time.perf_counter()
+                catprint.JobQueue(count).open_journal(path)
+                replay = time.perf_counter() - t0
+                ret[name].update( {'fsyncs':queue.journal.fsyncs, 'replay_sec':replay} )
+                line += '   %5d fsyncs   replaying them takes %6.1f ms'%(queue.journal.fsyncs, 1000*replay)
+            print(line)
+        finally:
+            shutil.rmtree(directory)
+    return ret
+
+
+def bench_dithering(height=2000):
+    print('dither_image, %dx%d from a photo, numpy %s'%(catprint.PrinterWidth, height, 'available' if catprint.have_numpy() else 'missing'))
+    im = catprint.ensure_pilim(phone_photo()).convert('L').resize((catprint.PrinterWidth, height))
+    ret = {}
+    for mode in catprint.dither_modes:
+        t, out = timed(catprint.dither_image, im, mode)
+        assert out.mode == '1' and out.size == im.size
+        print('  %-16s %7.1f ms'%(mode, 1000*t))
+        ret[mode] = {'sec':t}
+    t, _ = timed(lambda: im.point(catprint.tone_lut(1.15, 1.35, 1.2)), repeat=5)
+    print('  %-16s %7.1f ms'%('tone adjustment', 1000*t))
+    ret['tone adjustment'] = {'sec':t}
+    if catprint.have_numpy():
+        small = im.crop((0, 0, catprint.PrinterWidth, 200))
+        assert catprint.atkinson_dither(small).tobytes() == catprint.atkinson_dither_python(small).tobytes(), 'atkinson implementations differ'
+    return ret
+
+
+def bench_glyph_atlas():
+    print('text from a GlyphAtlas, against drawing it crisp with PIL (which it must match pixel for pixel), and antialiased')
+    if not catprint.have_numpy():
+        print('  numpy missing, skipped')
+        return {}
+    receipt = '\n'.join(receipt_lines)
+    fixtures = [ ('receipt, size %d'%size, receipt, size)  for size in (12, 16, 20, 24, 30, 40) ] + [
+                 ('short alert', short_alert, 30), ('long text', long_text, 30), ('indentation', '  indented\n    more\n\nblank above\n', 24),
+                 ('tabs', 'a\tb 12:00\nweb01\tload 0.42\n\tdisk 81%', 16), ('unicode', 'Ünïcödé — “quotes” € ½', 30) ]
+    ret = {}
+    for name, text, font_size in fixtures:
+        atlas = catprint.glyph_atlas('FreeSans.ttf', font_size)
+        t_atlas, got = timed(atlas.text_image, text, repeat=20)
+        t_crisp, want = timed(lambda: catprint.prepare_image(catprint.generate_text_image(text, font_size=font_size, crisp=True)), repeat=5)
+        t_aa, _       = timed(lambda: catprint.prepare_image(catprint.generate_text_image(text, font_size=font_size)), repeat=5)
+        assert got.size == want.size  and  got.tobytes() == want.tobytes(), '%s: atlas differs from PIL'%name
+        print('  %-18s atlas %6.2f ms   crisp %6.2f ms (%5.1fx)   antialiased %6.2f ms'%(name, 1000*t_atlas, 1000*t_crisp, t_crisp/t_atlas, 1000*t_aa))
+        # (with a little slack for lines the atlas hands to FreeType, which then takes most of the time either way)
+        assert t_atlas < 1.1 * t_crisp, '%s: atlas slower than PIL'%name
+        # (bigger, the time goes with the ink, about 1 ms at 30 and 2-3 ms at 40, where nearly every line needs word-wrapping too)
+        if text == receipt  and  font_size <= 24:
+            assert t_atlas < 0.001, '%s: atlas took %.2f ms'%(name, 1000*t_atlas)
+        ret[name] = {'atlas_sec':t_atlas, 'crisp_sec':t_crisp, 'antialiased_sec':t_aa, 'size':got.size}
+    return ret
+
+
+def paper_seconds(commands):
+    ' how long a SimulatedPrinter, at its default paper speed, takes to print commands (it does not actually wait for that) '
+    async def run():
+        printer = catprint.SimulatedPrinter()
+        printer.receive(commands)
+        if printer.printing is not None:
+            printer.printing.cancel()
+        return printer.stats['paper_seconds']
+    return asyncio.run(run())
+
+
+def bench_density_speeds(model='MX06'):
+    print('printing at one speed and energy, vs. per band by how much ink it has (catprint.density_profile), as a simulated %s would take'%model)
+    ret = {}
+    profiles = catprint.density_profiles
+    adaptive = {model: catprint.density_profile}  # (not on for any model by default)
+    try:
+        for name, kind, data, option in pipeline_fixtures():
+            if kind == 'text':
+                image = catprint.prepare_image( catprint.render_text(data, font_size=option) )
+            else:
+                image = catprint.prepare_image( catprint.decode_image(data, option.rotate) )
+            energy = catprint.job_energy(kind)
+            line = '  %-12s %6d rows'%(name, image.height)
+            for mode, catprint.density_profiles in (('fixed', {}), ('adaptive', adaptive)):
+                t, commands = timed(catprint.image_to_drawcommands, image, energy=energy, model=model)
+                paper = paper_seconds(commands)
+                line += '   %s: encode %6.1f ms, on paper %6.1f sec'%(mode, 1000*t, paper)
+                ret['%s, %s'%(name, mode)] = {'encode_sec':t, 'paper_sec':paper}
+            rows = catprint.image_to_rows(image)
+            speeds = collections.Counter( catprint.band_settings(rows[y:y+catprint.band_height*catprint.RowBytes], adaptive[model], energy)[0]
+                                          for y in range(0, len(rows), catprint.band_height*catprint.RowBytes) )
+            print(line + '   bands per speed: %s'%', '.join( '0x%02X: %d'%item  for item in sorted(speeds.items()) ))
+    finally:
+        catprint.density_profiles = profiles
+    return ret
+
+
+def python_seconds(code, repeat=5):
+    ' best wall time of running python -c code in a fresh process, from here (so including the interpreter starting) '
+    return min( timed(subprocess.run, [sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(catprint.__file__)), check=True, repeat=1)[0]
+                for _ in range(repeat) )
+
+
+def seconds_to_ready(web_server, timeout=30):
+    ' starts  catprint.py --no-browser --simulated  in a fresh process, returns how long until its web API answers /status '
+    port = catprint.find_free_port()
+    directory = tempfile.mkdtemp() # for its journal and known printers
+    t0 = time.perf_counter()
+    daemon = subprocess.Popen([sys.executable, os.path.abspath(catprint.__file__), '--no-browser', '--simulated', '--port', str(port), '--web-server', web_server],
+                              cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            try:
+                with urllib.request.urlopen('http://localhost:%d/status'%port, timeout=1):
+                    return time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.005)
+        raise RuntimeError('catprint.py did not answer on port %d within %d sec'%(port, timeout))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(directory)
+
+
+def bench_startup(repeat=5):
+    print('starting up, in fresh processes: importing catprint (which leaves bleak, numpy and the web side for later), and the daemon until its web API answers')
+    ret = {}
+    lazy     = subprocess.run([sys.executable, '-c', "import sys, catprint; print(*[ name  for name in ('bleak', 'numpy', 'flask', 'aiohttp')  if name in sys.modules ])"],
+                              cwd=os.path.dirname(os.path.abspath(catprint.__file__)), check=True, capture_output=True, text=True).stdout.split()
+    assert not lazy, 'import catprint also imported %s'%', '.join(lazy)
+    bare     = python_seconds('pass', repeat)
+    imported = python_seconds('import catprint', repeat)
+    eager    = python_seconds('import catprint, bleak, flask' + (', numpy'  if importlib.util.find_spec('numpy')  else '') + (', aiohttp.web'  if importlib.util.find_spec('aiohttp')  else ''), repeat)
+    print('  python itself          %7.1f ms'%(1000*bare))
+    print('  import catprint        %7.1f ms   (+%5.1f ms)'%(1000*imported, 1000*(imported-bare)))
+    print('  and bleak, numpy, web  %7.1f ms   (+%5.1f ms)'%(1000*eager, 1000*(eager-bare)))
+    ret['import'] = {'python_sec':bare, 'sec':imported, 'with_everything_sec':eager}
+    for web_server in ('flask', 'aiohttp'):
+        if web_server == 'aiohttp'  and  not importlib.util.find_spec('aiohttp'):
+            continue
+        ready = min( seconds_to_ready(web_server)  for _ in range(repeat) )
+        print('  daemon, %-8s ready   %7.1f ms'%(web_server, 1000*ready))
+        ret['ready, %s'%web_server] = {'sec':ready}
+    return ret
+
+
+def bench_compiled_jobs(count=20):
+    print('%d receipts (different ones, job cache off) through the printer loop, stop-and-wait: as text jobs, vs. compiled ahead of time and printed from their files, as one directory'%count)
+    jobs = [ ('text', 'Order %d\n'%i + '\n'.join(receipt_lines), 16)  for i in range(count) ]
+    ret = {}
+    directory = tempfile.mkdtemp(dir='.')
+    cache_bytes, catprint.job_cache.max_bytes = catprint.job_cache.max_bytes, 0
+    try:
+        t0 = time.perf_counter()
+        compiled = [ catprint.compile_job(*job, os.path.join(directory, '%04d%s'%(i, catprint.CompiledJob.suffix)))  for i, job in enumerate(jobs) ]
+        took = time.perf_counter() - t0
+        size = sum( os.path.getsize(job.path)  for job in compiled )
+        print('  compiling         %7.1f ms per job, %6.0f bytes per job file'%(1000*took/count, size/count))
+        ret['compile'] = {'sec_per_job':took/count, 'bytes_per_job':size/count}
+        for link_name, link in (('instant link', dict(bandwidth=1e9, latency=0, paper_speed=1e9, flow_control=False)),
+                                ('ble-ish link', dict(bandwidth=20000, latency=0.01, paper_speed=1e9, flow_control=False))):
+            for name, queued, entries in (('text jobs', jobs, None), ('compiled', [('compiled', directory, None)], count)):
+                took, simulated, printer = asyncio.run( print_through_scheduler(queued, entries=entries, **link) )
+                rate = simulated.stats['bytes'] / took
+                print('  %-13s %-10s %6.2f sec, %6.1f jobs/sec, %8.0f bytes/sec, %4.1f status checks per job%s'%(
+                    link_name, name, took, count/took, rate, printer.status_checks/count, '  (%3.0f%% of the link)'%(100*rate/link['bandwidth'])  if link['bandwidth'] < 1e9  else ''))
+                ret['%s, %s'%(link_name, name)] = {'sec':took, 'jobs_per_sec':count/took, 'bytes_per_sec':rate, 'status_checks_per_job':printer.status_checks/count}
+            assert ret['%s, compiled'%link_name]['status_checks_per_job'] <= 1.5, 'a compiled directory should take one status check per file'
+    finally:
+        catprint.job_cache.max_bytes = cache_bytes
+        shutil.rmtree(directory)
+    return ret
+
+
+benchmarks = {
+    'framing':          bench_framing,
+    'encoder':          bench_encoder,
+    'text_rendering':   bench_text_rendering,
+    'blank_collapsing': bench_blank_collapsing,
+    'streaming':        bench_streaming,
+    'dithering':        bench_dithering,
+    'decode':           bench_decode,
+    'pipeline':         bench_pipeline,
+    'end_to_end':       bench_end_to_end,
+    'printer_pool':     bench_printer_pool,
+    'strip_streaming':  bench_strip_streaming,
+    'journal':          bench_journal,
+    'glyph_atlas':      bench_glyph_atlas,
+    'density_speeds':   bench_density_speeds,
+    'startup':          bench_startup,
+    'compiled_jobs':    bench_compiled_jobs,
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('names', nargs='*', metavar='name', help='which to run: %s (default: all)'%', '.join(benchmarks))
+    parser.add_argument('--json', metavar='FILE', help='also write the results to this file')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error('no benchmark called %r'%name)
+
+    results = {}
+    for name in args.names or benchmarks:
+        results[name] = benchmarks[name]()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'commit':git_commit(), 'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':platform.python_version(),
+                        'pillow':PIL.__version__, 'machine':platform.machine(), 'results':results }, f, indent=1)
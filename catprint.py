@@ -8,15 +8,19 @@
 # - don't build up notification requests before connect
 
 
-import sys, time, asyncio, threading, traceback, io, socket, contextlib
+import os, time, json, asyncio, threading, io, socket, contextlib, re, functools, hashlib, collections, heapq, itertools, logging, concurrent.futures, math, tempfile, shutil, struct, zlib, mmap
+import argparse, importlib.util, sys
+import_started = time.perf_counter() # see cli
 
-from bleak import BleakClient, BleakScanner
-from bleak.exc import BleakError
+# bleak, flask, aiohttp and numpy get imported where they are first needed (see BleakTransport, flask_app, start_aiohttp, have_numpy),
+# so that using this module to encode things does not pay for them, and the daemon starts looking for printers before it loads its web side
 import PIL.Image
 import PIL.ImageDraw
 import PIL.ImageFont
 import PIL.ImageChops
-from flask import Flask, request, jsonify
+numpy   = None    # optional, makes atkinson dithering and text_atlas fast.  Imported by have_numpy, False if it is missing
+aiohttp = None    # optional, see web_server.  Imported by start_aiohttp
+flask   = None    # imported by flask_app
 
 
 ########################### constants, variables, and helpers
@@ -32,6 +36,8 @@ OtherFeedPaper         = 0xBD  # Data: one byte, set to a device-specific "Speed
 DrawingMode            = 0xBE  # Data: 1 for Text, 0 for Images
 SetEnergy              = 0xAF  # Data: 1 - 0xFFFF
 SetQuality             = 0xA4  # Data: 0x31 - 0x35. APK always sets 0x33 for GB01
+FlowControl            = 0xAE  # From the printer, data 0x10 means stop sending (XOff), 0x00 means go on (XOn)
+DrawCompressedBitmap   = 0xBF  # Data: Line to draw, run-length encoded: per byte, top bit is ink-or-not, low 7 bits the run length. Not on all models.
 
 PrintLattice           = [ 0xAA, 0x55, 0x17, 0x38, 0x44, 0x5F, 0x5F, 0x5F, 0x44, 0x38, 0x2C ]
 FinishLattice          = [ 0xAA, 0x55, 0x17, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x17 ]
@@ -39,6 +45,11 @@ FinishLattice          = [ 0xAA, 0x55, 0x17, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,
 #XOn                   = ( 0x51, 0x78, 0xAE, 0x01, 0x01, 0x00, 0x00, 0x00, 0xFF )
 
 PrinterWidth           = 384
+RowBytes               = PrinterWidth // 8
+# maps a byte of PIL mode "1" data (MSB is leftmost pixel, 1 is white) to what DrawBitmap wants (LSB is leftmost pixel, 1 is ink)
+BlankRow               = bytes(RowBytes)
+RowByteTable           = bytes( int('{:08b}'.format(b ^ 0xFF)[::-1], 2)  for b in range(256) )
+InkCountTable          = bytes( bin(b).count('1')  for b in range(256) )  # dots of ink in a byte of DrawBitmap data
 #ImgPrintSpeed         = [ 0x23 ]
 #BlankSpeed            = [ 0x19 ]
 
@@ -46,25 +57,77 @@ ImgPrintSpeed          = [ 0x19 ]
 BlankSpeed             = [ 0x05 ]
 
 packet_length           = 220      # not sure what the real limit is, should probably find out
+band_height             = 64       # rows encoded at a time, see drawcommand_bands
+transfer_mode           = 'stopandwait' # the old way, which asks for status after every command_queue entry and waits for write acknowledgement.
+                                   # Or 'pipelined', which is faster, but leans on XOff/XOn that not all models send (the MX06 never does) - try it per model
+pipeline_window         = 8        # pipelined: at most this many packets unacknowledged - every this many'th write waits for the printer's acknowledgement
+xoff_timeout            = 5        # pipelined: seconds we respect an XOff before sending anyway
+job_executor_kind       = 'thread' # 'thread' or 'process': where decoding, rendering and dithering happen, so that it never blocks the bluetooth loop
+job_workers             = 2        # how many of those, which is also how many jobs get prepared ahead of printing
+max_queued_jobs         = 100      # more than that waiting and the web API answers 429, rather than us piling up memory
+status_interval         = 1.0      # seconds between status requests while there's nothing to do (also keeps the printer awake)
+job_cache_bytes         = 16*1024*1024 # memory for remembering encoded jobs, so that reprinting the same thing skips all of the work
+coalesce_jobs           = 1        # when a printer takes a job and more are waiting, take up to this many in all, and print them in one go (see prepare_batch)
+spool_upload_bytes      = 1024*1024 # uploads larger than this wait in a temporary file rather than in memory
+max_decode_pixels       = 50*1000*1000 # images that are still larger than this when decoded at reduced size get refused, see decode_image
+compiled_jobs_dir       = 'compiled' # /print-compiled prints job files from here (made with  python catprint.py compile, see CompiledJob)
+text_atlas              = False    # draw text jobs crisp (not antialiased), assembled from glyphs rendered once (see GlyphAtlas). Much faster for receipts and status lines
+stream_rows             = 2000     # jobs at least this many rows high print a band at a time, with a status check after each (see StreamedPrint). None: never
+band_status_timeout     = 2        # seconds a StreamedPrint waits for the answer after a band.  A printer that does not answer while printing
+                                   # gets the rest of its bands (for as long as it stays connected) without those checks
 
 PrinterCharacteristic  = "0000AE01-0000-1000-8000-00805F9B34FB"
 NotifyCharacteristic   = "0000AE02-0000-1000-8000-00805F9B34FB"
 
-#specific_macs          = ()
+collapse_blank_rows    = True     # send runs of all-white rows as one FeedPaper instead of a DrawBitmap per row
+compressed_bitmap_printer_names = (  # models that understand DrawCompressedBitmap; others get plain DrawBitmap rows
+    'GB03',   # reportedly - not tested here
+)
+
 accepted_printer_names = (
     'MX06',   # tested because I have this one
     'GB01','GB02','GB03','GT01','YT01','MX05','MX08','MX10', # mentioned at https://www.devzery.com/post/cat-printers and presumed to be be compatible enough, but may vary in some details?
 )
 
-bluetooth_on           = False
-device                 = None
-awaiting_status        = False
+# Per model: how fast and how hard to print a band, by how much of it is ink, so that text goes through quickly
+# and photos slowly enough not to come out faint or overheat the head.  Entries are (up to this fraction of the band's dots being ink,
+# OtherFeedPaper speed byte, factor for the job's energy), sparsest first.  The speed byte seems to be a delay (we feed blank paper with 0x05),
+# so lower is faster.  Models not listed print everything at ImgPrintSpeed with the job's energy.  See band_settings.
+# None listed yet: density_profile is a guess, and slows dense jobs down, so add a model only once its prints have been checked with it,
+# e.g.  density_profiles = {'MX06': density_profile}
+density_profile        = ( (0.2, 0x0F, 1.0),  (0.4, ImgPrintSpeed[0], 1.0),  (1.0, 0x23, 1.15) )  # text, mostly under 20%;  then photos
+density_profiles       = {}
 
-status                 = {}
-last_communication     = time.time()
-command_queue          = []
-image_queue            = []
-text_queue             = []
+printer_selectors      = ()  # MAC addresses and/or names of the printers to keep connected to, e.g. ('MX06', 'AA:BB:CC:DD:EE:FF')
+                             # (a name listed twice means two printers by that name).  Empty means: the first accepted printer we find.
+
+bluetooth_on           = False
+printers               = []    # Printer objects, one per printer_selectors entry
+scan_lock              = asyncio.Lock()  # one scan at a time
+scan_seconds           = 5     # how long a scan looks for the printer (it stops as soon as it sees it)
+scan_backoff_max       = 60    # seconds. After failing to find the printer, wait 1, 2, 4, ... up to this long before scanning again
+known_printers_file    = 'known_printers.json'  # {address:name} of printers we connected to before, most recent last
+direct_connect_timeout = 3     # seconds to try connecting to a known address before falling back to a scan
+printer_transport      = 'bleak'  # or 'simulated': talk to a SimulatedPrinter (per printer) instead, to try things out without hardware
+simulated_printer_options = {}    # e.g. {'bandwidth':5000, 'paper_speed':100}, see SimulatedPrinter
+status_timeout         = 10    # seconds without an answer to a status request before we consider the connection lost
+printer_loop           = None  # the event loop the bluetooth side runs in, so notifications from other threads can be handed to it
+job_executor           = None
+
+log_level              = 'INFO'  # DEBUG shows every send, status answer, and web request;  WARNING only shows trouble
+job_trace_file         = None    # e.g. 'jobs.log': appends a JSON line per printed job, with its time per stage
+job_journal_file       = 'jobs.journal' # accepted jobs are written here before we say so, and ones not printed yet get queued again on the next start.
+                                        # None keeps them in memory only (faster to submit, lost on restart)
+
+web_host               = 'localhost' # where the web API listens (cli: --host).  '0.0.0.0' for everywhere
+web_port               = None    # None picks a free port each time (cli: --port)
+web_server             = 'flask' # or 'aiohttp': serve the web API from the bluetooth event loop rather than a thread next to it,
+                                 # and push status to the page (/events) rather than have each open page ask twice a second
+status_push_interval   = 2       # aiohttp: seconds between status pushes while nothing changes (so 'seconds since we heard from the printer' keeps counting)
+status_push_min_interval = 0.2   # aiohttp: no more status pushes than one per this many seconds, however much is going on
+
+log                    = logging.getLogger('catprint')
+trace_log              = logging.getLogger('catprint.trace') # see job_trace_file
 
 def find_free_port():
     ' Try to find a TCP port not currently used ' 
@@ -74,7 +137,20 @@ def find_free_port():
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         return s.getsockname()[1]
 
-webport = find_free_port()
+
+async def wait_for(awaitable, timeout):
+    """ asyncio.wait_for, minus its habit (before python 3.12) of swallowing a cancel that comes in just as what it waits for completes
+        - which could leave a cancelled printer loop running.  Raises asyncio.TimeoutError after timeout seconds
+    """
+    future = asyncio.ensure_future(awaitable)
+    try:
+        done, _ = await asyncio.wait( (future,), timeout=timeout )
+    finally:
+        if not future.done():
+            future.cancel()
+    if not done:
+        raise asyncio.TimeoutError()
+    return future.result()
 
 
 def trim_image(im):
@@ -96,54 +172,969 @@ def image_strips(im):
     return ret
 
 
-def generate_text_image(text, font_name="FreeSans.ttf", font_size=30):
-    ' Copied from the mentioned code. There is likely a better way to do nice wrapping. '
-    def get_wrapped_text(text: str, font: PIL.ImageFont.ImageFont, line_length: int):
-        if font.getlength(text) <= line_length:
-            return text
-        lines = ['']
-        for word in text.split():
-            line = f'{lines[-1]} {word}'.strip()
-            if font.getlength(line) <= line_length:
-                lines[-1] = line
-            else:
-                lines.append(word)
-        return '\n'.join(lines)
-
-    img = PIL.Image.new('RGB', (PrinterWidth, 5000), color = (255, 255, 255))
-    font = PIL.ImageFont.truetype(font_name, font_size)
-    
+@functools.lru_cache(maxsize=16)
+def get_font(font_name, font_size):
+    ' PIL.ImageFont.truetype, cached - loading the font file was a good part of the time spent rendering a short text '
+    return PIL.ImageFont.truetype(font_name, font_size)
+
+
+@functools.lru_cache(maxsize=4096)
+def char_length(font, char):
+    ' font.getlength of a single character, cached (font.getlength loads every glyph every time, at ~10us per character) '
+    return font.getlength(char)
+
+
+@functools.lru_cache(maxsize=4096)
+def char_bearing(font, char):
+    ' how far right of where it is drawn the ink of a single character starts; cached '
+    mask, offset = font.getmask2(char)
+    bbox = mask.getbbox()
+    return offset[0] + bbox[0]  if bbox  else 0
+
+
+def wrap_text(text, font, line_length):
+    """ Word-wraps one paragraph to at most line_length pixels wide; returns it with newlines inserted.
+        Adds up cached character widths, rather than measuring the whole growing line for every word
+        (that ignores kerning, which only ever makes a line a pixel or so narrower than we think).
+    """
+    if sum( char_length(font, char)  for char in text ) <= line_length:
+        return text
+    space = char_length(font, ' ')
+    lines, words, width = [], [], 0
+    for word in text.split():
+        word_length = sum( char_length(font, char)  for char in word )
+        if words  and  width + space + word_length > line_length:
+            lines.append( ' '.join(words) )
+            words, width = [], 0
+        width += (space if words else 0) + word_length
+        words.append(word)
+    lines.append( ' '.join(words) )
+    return '\n'.join(lines)
+
+
+def line_ink(font, line, mode='L'):
+    ' the rows the ink of one line of text covers, from where it gets drawn (antialiased, or with mode "1" without): (top, bottom), or its box if it has no ink '
+    mask, (x, y) = font.getmask2(line, mode=mode)
+    bbox = mask.getbbox()
+    if bbox is None:
+        _, top, _, bottom = font.getbbox(line)
+        return top, bottom
+    return y + bbox[1], y + bbox[3]
+
+
+def text_layout(text, font, crisp=False):
+    """ Where generate_text_image puts text: returns (lines, line_spacing, top, left, height),
+        where line i gets drawn at (-left, i*line_spacing - top) on an image height high.  Text must have something besides whitespace.
+    """
+    lines = "\n".join( wrap_text(line, font, PrinterWidth)  for line in text.splitlines() ).split('\n')
+
+    # Work out the height first, so that we can draw on an image of the right size rather than trimming a huge one.
+    # Lines are spaced the way PIL's multiline text does it. The image starts where the ink of the first line with any starts
+    # (not its box, which reaches higher: this is where trimming the image used to cut), and at the left where the leftmost line's ink starts.
+    line_spacing = font.getbbox('A')[3] + 4
+    inked  = [ i  for i, line in enumerate(lines)  if line.strip() ]
+    top    = inked[0]  * line_spacing  +  line_ink(font, lines[inked[0]],  '1'  if crisp  else 'L')[0]
+    bottom = inked[-1] * line_spacing  +  line_ink(font, lines[inked[-1]], '1'  if crisp  else 'L')[1]
+    left   = min( sum( char_length(font, char)  for char in line[:len(line)-len(line.lstrip())] )  +  char_bearing(font, line.lstrip()[0])
+                  for line in lines  if line.strip() )
+    return lines, line_spacing, top, left, bottom-top+10 # (a little extra at the bottom so the end doesn't get cut off)
+
+
+def generate_text_image(text, font_name="FreeSans.ttf", font_size=30, crisp=False):
+    """ Renders text, word-wrapped to the printer width, onto an image just high enough for it
+        (plus a little at the bottom so the end doesn't get cut off).
+        crisp draws it without antialiasing, which is what a GlyphAtlas does faster.
+        Returns None if there's nothing to print.
+    """
+    if not text.strip():
+        return None
+    font = get_font(font_name, font_size)
+    lines, line_spacing, top, left, height = text_layout(text, font, crisp)
+
+    img = PIL.Image.new('L', (PrinterWidth, height), color=255)
     d = PIL.ImageDraw.Draw(img)
-    lines = []
-    for line in text.splitlines():
-        lines.append( get_wrapped_text(line, font, PrinterWidth) )
-    lines = "\n".join(lines)
-    d.text((0,0), lines, fill=(0,0,0), font=font)
-    return trim_image(img)
+    if crisp:
+        d.fontmode = '1'
+    for i, line in enumerate(lines):
+        if line.strip():
+            d.text((-left, i*line_spacing - top), line, fill=0, font=font)
+    return img
+
+
+class GlyphAtlas:
+    """ The glyphs of one font at one size, each rendered once without antialiasing, and kept as the coordinates of its ink
+        along with its advance.  text_image assembles a whole text from those in a handful of numpy operations,
+        rather than PIL laying out and drawing each line: the same pixels as generate_text_image(crisp=True), in a fraction of the time.
+
+        That relies on placing glyphs the way PIL does: at the pen position rounded to a whole pixel, the whole line moved left 
+        if its first glyph sticks out to the left.  Some glyphs (mostly accented ones, at some sizes) also move the rest of their line 
+        up or down a pixel, so each new glyph gets checked against what PIL draws, and lines with any that do not fit get their ink 
+        from FreeType after all.  The layout (text_layout) comes from the atlas too: how high and low the ink of each glyph reaches, 
+        and its advance, which is a whole number of 1/64 pixels, so that widths add up exactly.
+        Glyphs get added as text needs them.  Needs numpy (see have_numpy); get one with glyph_atlas, which keeps them around.
+    """
+    def __init__(self, font_name, font_size):
+        if not have_numpy():
+            raise ImportError('GlyphAtlas needs numpy')
+        self.font_name = font_name
+        self.font_size = font_size
+        self.font      = get_font(font_name, font_size)
+        self.line_spacing = self.font.getbbox('A')[3] + 4  # as text_layout has it
+        self.lock      = threading.Lock()  # job executor threads may add glyphs at the same time
+        self.ids       = numpy.full(256, -1, dtype=numpy.int64)  # code point -> glyph id, -1 for not seen yet
+        self.glyphs    = []    # per glyph id: (advance in 1/64 pixel, ink rows, ink columns from the pen, how far PIL moves a line starting with it, whether it fits)
+        self.advance = self.count = self.start = self.ink_at = self.lead = self.fits = None # self.glyphs as arrays, see add
+        self.top = self.bottom = None  # per glyph id, the first row of its ink and the one after its last (huge and tiny for none)
+        self.margin = self.stride = None  # text_image draws on a canvas with margin blank columns either side (so stride wide) and twice that above and below
+        self.add( [ord('n'), ord('H')] + list(range(32, 127)) )
+
+    def add(self, codes):
+        ' renders the glyphs for code points, the way PIL draws each inside a line of text, and checks that they really come out that way '
+        with self.lock:
+            codes = list(dict.fromkeys( code  for code in codes  if code >= len(self.ids)  or  self.ids[code] < 0 ))
+            if not codes:
+                return
+            if max(codes) >= len(self.ids):
+                self.ids = numpy.concatenate( (self.ids, numpy.full(max(codes)+1-len(self.ids), -1, dtype=numpy.int64)) )
+            for code in codes:
+                ys, xs, x, y = self.rendered( chr(code) )
+                self.ids[code] = len(self.glyphs)
+                self.glyphs.append( [round(self.font.getlength(chr(code)) * 64), ys + y, xs, x, None] )
+            for code in codes: # with all of them there, so that the checks can use n and H
+                glyph = self.glyphs[self.ids[code]]
+                glyph[4] = all( self.placed(text) == self.ink(text)  for text in (chr(code), 'n%sn'%chr(code), 'H%sH'%chr(code), ' %s'%chr(code)) )
+            self.advance = numpy.array( [glyph[0]  for glyph in self.glyphs], dtype=numpy.int64 )
+            self.count   = numpy.array( [len(glyph[1])  for glyph in self.glyphs], dtype=numpy.int64 )
+            self.start   = numpy.cumsum(self.count) - self.count
+            ink_y        = numpy.concatenate( [glyph[1]  for glyph in self.glyphs] ).astype(numpy.int64)
+            ink_x        = numpy.concatenate( [glyph[2]  for glyph in self.glyphs] ).astype(numpy.int64)
+            self.margin  = 1 + int( max(abs(ink_y).max(), ink_x.max()) )  # (enough for any glyph drawn partly off the edge)
+            self.stride  = PrinterWidth + 2*self.margin
+            self.ink_at  = (ink_y * self.stride + ink_x).astype(numpy.int32)  # as offsets into the canvas
+            self.lead    = numpy.array( [glyph[3]  for glyph in self.glyphs], dtype=numpy.int64 )
+            self.fits    = numpy.array( [glyph[4]  for glyph in self.glyphs], dtype=bool )
+            self.top     = numpy.array( [glyph[1].min()  if len(glyph[1])  else 1<<30  for glyph in self.glyphs], dtype=numpy.int64 )
+            self.bottom  = numpy.array( [glyph[1].max()+1  if len(glyph[1])  else -1<<30  for glyph in self.glyphs], dtype=numpy.int64 )
+
+    def glyph_ids(self, lines):
+        ' the glyph ids of the characters of lines, all in a row (adding any not seen yet), and how many characters each line has '
+        codes = numpy.frombuffer( ''.join(lines).encode('utf-32-le'), dtype=numpy.uint32 ).astype(numpy.int64)
+        if len(codes)  and  (codes.max() >= len(self.ids)  or  (self.ids[codes] < 0).any()):
+            self.add( codes.tolist() )
+        with self.lock:
+            return self.ids[codes], numpy.array( [len(line)  for line in lines], dtype=numpy.int64 )
+
+    def rendered(self, text, start=(0, 0)):
+        ' what PIL draws for one line of text: returns (rows, columns, x, y), the ink being at (rows+y, columns+x) from where the line is drawn '
+        mask, (x, y) = self.font.getmask2(text, mode='1', start=start)
+        ys, xs = numpy.asarray(mask, dtype=numpy.uint8).reshape(mask.size[1], mask.size[0]).nonzero()
+        return ys, xs, x, y
+
+    def ink(self, text):
+        ' where PIL puts the ink of one line of text, as a set of (y, x) '
+        ys, xs, x, y = self.rendered(text)
+        return set( zip( (ys + y).tolist(), (xs + x).tolist() ) )
+
+    def placed(self, text):
+        ' where we would put the ink of one line of text, as a set of (y, x) '
+        ink, pen, lead = set(), 0, None
+        for char in text:
+            advance, ys, xs, shift = self.glyphs[ self.ids[ord(char)] ][:4]
+            if lead is None:
+                lead = shift
+            ink.update( zip( ys.tolist(), (xs + ((pen + 32) >> 6) + lead).tolist() ) )
+            pen += advance
+        return ink
+
+    def text_image(self, text):
+        """ The same pixels as prepare_image(generate_text_image(text, crisp=True)), as a mode "1" image PrinterWidth wide.
+            Returns None if there's nothing to print.
+        """
+        if not text.strip():
+            return None
+        lines  = [ line  if line.strip() else ''  for line in text.splitlines() ] # (generate_text_image does not draw those at all)
+        glyphs, lengths = self.glyph_ids(lines)
+        with self.lock: # (add may be swapping the arrays)
+            fits, advance, first, count, start, ink_at, margin, stride, tops, bottoms = \
+                self.fits, self.advance, self.lead, self.count, self.start, self.ink_at, self.margin, self.stride, self.top, self.bottom
+        pen    = numpy.concatenate( ([0], numpy.cumsum(advance[glyphs])) )
+        ends   = numpy.cumsum(lengths)
+        wide   = pen[ends] - pen[ends-lengths] > PrinterWidth * 64
+        if wide.any(): # word-wrap those lines (and only those, wrap_text would just add them up again)
+            lines  = "\n".join( wrap_text(line, self.font, PrinterWidth)  if too_wide  else line  for line, too_wide in zip(lines, wide.tolist()) ).split('\n')
+            glyphs, lengths = self.glyph_ids(lines)
+            pen    = numpy.concatenate( ([0], numpy.cumsum(advance[glyphs])) )
+            ends   = numpy.cumsum(lengths)
+        starts = ends - lengths
+
+        left   = min( sum( char_length(self.font, char)  for char in line[:len(line)-len(line.lstrip())] )  +  char_bearing(self.font, line.lstrip()[0])
+                      for line in lines  if line )
+        frac, whole = math.modf(-left)
+
+        # lines with glyphs that do not fit: their ink as FreeType has it
+        misfits = numpy.concatenate( ([0], numpy.cumsum(~fits[glyphs])) )
+        misfits = (misfits[ends] - misfits[starts]).nonzero()[0]
+        drawn   = { i: self.rendered(lines[i], (frac, 0))  for i in misfits.tolist() }
+
+        def ink_rows(i):
+            ' line_ink(self.font, lines[i], "1"), from what FreeType drew of it, or from the ink of its glyphs '
+            if i in drawn:
+                rows, _, _, y = drawn[i]
+                if len(rows):
+                    return int(rows.min()) + y, int(rows.max()) + 1 + y
+            else:
+                top, bottom = int(tops[ glyphs[starts[i]:ends[i]] ].min()), int(bottoms[ glyphs[starts[i]:ends[i]] ].max())
+                if top < bottom:
+                    return top, bottom
+            return line_ink(self.font, lines[i], '1') # (no ink at all)
+        # the rest of what text_layout(crisp=True) works out with PIL
+        inked  = lengths.nonzero()[0]
+        top    = inked[0]  * self.line_spacing  +  ink_rows(inked[0])[0]
+        height = inked[-1] * self.line_spacing  +  ink_rows(inked[-1])[1]  -  top  +  10
+        if len(misfits):
+            lengths = lengths.copy()
+            lengths[misfits] = 0
+            keep    = numpy.repeat(lengths > 0, ends - starts)
+            glyphs, pen = glyphs[keep], pen[:-1][keep]
+            starts  = numpy.cumsum(lengths) - lengths
+            pen     = pen - numpy.repeat(pen[starts[lengths > 0]], lengths[lengths > 0])
+        else:
+            pen     = pen[:-1] - numpy.repeat(pen[starts], lengths)
+        # pen position of each character within its line is now in pen, in 1/64 pixel; where each character gets drawn, rounded the way PIL does
+        lead    = numpy.zeros(len(lines), dtype=numpy.int64)
+        lead[lengths > 0] = first[ glyphs[starts[lengths > 0]] ]
+        char_x  = ((pen + round(frac * 64) + 32) >> 6)  +  int(whole)  +  numpy.repeat(lead, lengths)
+        char_y  = numpy.repeat( numpy.arange(len(lines), dtype=numpy.int64) * self.line_spacing - top, lengths )
+        near    = (char_x > -margin) & (char_x < PrinterWidth) & (char_y > -margin) & (char_y < height) # (the rest is off the page)
+        glyphs  = glyphs[near]
+        char_at = ((char_y[near] + 2*margin) * stride  +  char_x[near] + margin).astype(numpy.int32)
+        # every inked pixel of every character (in 32 bits, which halves the memory that goes through here)
+        counts  = count[glyphs]
+        ink     = numpy.repeat((start[glyphs] - (numpy.cumsum(counts) - counts)).astype(numpy.int32), counts) + numpy.arange(counts.sum(), dtype=numpy.int32)
+        canvas  = numpy.ones((height + 4*margin) * stride, dtype=bool) # white
+        canvas[ ink_at[ink] + numpy.repeat(char_at, counts) ] = False
+        page    = canvas.reshape(height + 4*margin, stride)[2*margin:2*margin+height, margin:margin+PrinterWidth]
+        for i, (rows, columns, x, y) in drawn.items():
+            ys, xs  = rows + y + i * self.line_spacing - top,  columns + x + int(whole)
+            inside  = (xs >= 0) & (xs < PrinterWidth) & (ys >= 0) & (ys < height)
+            page[ys[inside], xs[inside]] = False
+        # PIL takes a byte per pixel faster than packed bits, and can skip the margins itself
+        return PIL.Image.frombytes('1', (PrinterWidth, height), memoryview(canvas)[2*margin*stride + margin:], 'raw', '1;8', stride)
+
+def have_numpy():
+    ' imports numpy the first time it is needed (that takes ~100 ms, which only dithering and text_atlas should pay); returns whether there is one '
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy is not False
+
+
+@functools.lru_cache(maxsize=16)
+def glyph_atlas(font_name, font_size):
+    ' the GlyphAtlas for a font and size, made the first time it is asked for '
+    return GlyphAtlas(font_name, font_size)
+
+
+def render_text(text, font_name="FreeSans.ttf", font_size=30):
+    """ How text jobs get drawn: generate_text_image, or with text_atlas, crisp from a GlyphAtlas 
+        (or if numpy is missing, generate_text_image(crisp=True), which gives the same pixels, slower).
+        Returns None if there's nothing to print.
+    """
+    if not text_atlas:
+        return generate_text_image(text, font_name, font_size)
+    if not have_numpy():
+        return generate_text_image(text, font_name, font_size, crisp=True)
+    return glyph_atlas(font_name, font_size).text_image(text)
+
+
+SpooledUpload = collections.namedtuple('SpooledUpload', 'path size') # job data of a large upload, see spool_upload
+
+
+def spool_upload(stream):
+    """ Reads an upload.  Returns its bytes, or when it is larger than spool_upload_bytes, 
+        a SpooledUpload of the temporary file it was copied to (release_job_data removes that once the job no longer needs it)
+    """
+    head = stream.read(spool_upload_bytes + 1)
+    if len(head) <= spool_upload_bytes:
+        return head
+    fd, path = tempfile.mkstemp(prefix='catprint-', suffix='.upload')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(head)
+        shutil.copyfileobj(stream, f)
+        return SpooledUpload(path, f.tell())
+
+
+def release_job_data(data):
+    ' removes the temporary file of a SpooledUpload (or those of the parts of a batch); does nothing for other job data '
+    if isinstance(data, SpooledUpload):
+        with contextlib.suppress(OSError):
+            os.remove(data.path)
+    elif isinstance(data, tuple):
+        for _, part_data, _ in data:
+            release_job_data(part_data)
+
+
+def current_rss():
+    ' resident memory of this process in bytes, where that is cheap to find out (linux), else None '
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def decode_image(source, rotate='no'):
+    """ Opens file contents (bytes, or a SpooledUpload) as a PIL image, decoded at not much more than the size we print it at:
+        JPEGs decode straight to 1/2, 1/4 or 1/8 size (draft mode), other large images get reduce()d right after decoding.
+        Then flattens transparency onto white (only when there is any), and rotates (see ImageOptions) - after scaling down, where it is cheap.
+        Returns an image at least PrinterWidth wide (unless it was narrower to begin with), prepare_image scales the rest of the way.
+        Raises ValueError for images over max_decode_pixels even at reduced size, so one upload can't take all our memory.
+    """
+    image = PIL.Image.open( source.path  if isinstance(source, SpooledUpload)  else  io.BytesIO(source) )
+    w, h = image.size
+    turn = rotate == 'yes'  or  (rotate == 'long' and w > h)
+    across = h if turn else w # what ends up as the printed width
+    try:
+        if across > PrinterWidth:
+            scale = PrinterWidth / across
+            image.draft(None, (math.ceil(w*scale), math.ceil(h*scale))) # only JPEG does anything with this
+        if image.width * image.height > max_decode_pixels:
+            raise ValueError('image too large: %dx%d'%image.size)
+        image.load()
+    except Exception:
+        image.close() # (a SpooledUpload's file would otherwise stay open until the garbage collector gets to it)
+        raise
+
+    if image.mode == 'P': # palette images can't be reduced, and may have a transparent color
+        image = image.convert('RGBA'  if 'transparency' in image.info  else  'RGB')
+    across = image.height if turn else image.width
+    if across >= 2*PrinterWidth  and  image.mode in ('L', 'LA', 'RGB', 'RGBA', 'CMYK', 'I', 'F'):
+        image = image.reduce( across // PrinterWidth )
+
+    if image.mode in ('RGBA', 'LA')  or  'transparency' in image.info: # paste it on white
+        rgba = image.convert('RGBA')
+        image = PIL.Image.new('RGB', image.size, 'white')
+        image.paste(rgba, (0, 0), rgba)
+
+    if turn:
+        image = image.transpose(PIL.Image.Transpose.ROTATE_90)
+    return image
 
 
 def ensure_pilim(pil_or_bytes):
-    ' Takes what could be a PIL image, or file contents that PIL might open; returns a PIL image '
-    if type(pil_or_bytes) == PIL.Image.Image: # TODO: use isinstance
+    ' Takes what could be a PIL image, or file contents that PIL might open (see decode_image); returns a PIL image '
+    if isinstance(pil_or_bytes, PIL.Image.Image):
         return pil_or_bytes
+    return decode_image(pil_or_bytes)
+
+
+def prepare_job(kind, data, option):
+    """ The CPU-heavy part of a print job: decoding, text rendering, rotating, scaling, dithering.
+        Runs in the job executor (see get_job_executor), so must stay a plain picklable module-level function.
+        kind is 'text' (data is the text, option the font size), 'image' (data is file bytes or a SpooledUpload, option an ImageOptions),
+        or 'batch' (data is a tuple of text and image jobs, option a BatchOptions, see prepare_batch).
+        Returns an image for drawcommand_bands, and {stage:seconds} of how long it took 
+        (plus, where we can tell, rss_bytes: the most resident memory seen right after the big steps).
+        ('compiled' jobs, whose data is the path of a job file, do not come through here, see CompiledJob)
+    """
+    if kind == 'batch':
+        return prepare_batch(data, option)
+    times = {}
+    t0 = time.perf_counter()
+    if kind == 'text':
+        image = render_text(data, font_size=option)
+        times['render'] = time.perf_counter() - t0
+    else:
+        image = decode_image(data, option.rotate)
+        times['decode'] = time.perf_counter() - t0
+    rss = current_rss()
+    if image is None: # e.g. only whitespace
+        return None, times
+    t0 = time.perf_counter()
+    if kind == 'text':
+        prepared = prepare_image(image)
+    else:
+        prepared = prepare_image(image, option.dither, option.brightness, option.contrast, option.gamma)
+    times['prepare'] = time.perf_counter() - t0
+    if rss is not None:
+        times['rss_bytes'] = max(rss, current_rss())
+    return prepared, times
+
+
+def prepare_batch(parts, option):
+    """ prepare_job for a batch: prepares each part, and stacks them into one image, with option's separator in between.
+        That goes in the order they would come out of the printer if printed one by one: the first part at the bottom, since it prints first.
+        Returns that image (None if there is nothing to print), and {stage:seconds} summed over the parts
+    """
+    times, images = {}, []
+    for part in parts:
+        image, part_times = prepare_job(*part)
+        for stage, value in part_times.items():
+            times[stage] = max(times.get(stage, 0), value)  if stage == 'rss_bytes'  else  times.get(stage, 0) + value
+        if image is not None:
+            images.append(image)
+    if not images:
+        return None, times
+
+    t0 = time.perf_counter()
+    separator = separator_image(option.separator, option.gap)
+    stacked = PIL.Image.new('1', (PrinterWidth, sum( image.height  for image in images ) + option.gap*(len(images)-1)), 1)
+    y = stacked.height
+    for i, image in enumerate(images):
+        if i > 0:
+            y -= option.gap
+            stacked.paste(separator, (0, y))
+        y -= image.height
+        stacked.paste(image, (0, y))
+    times['prepare'] = times.get('prepare', 0) + time.perf_counter() - t0
+    return stacked, times
+
+
+batch_kinds = ('text', 'image', 'batch') # what batch_of can put in a batch
+
+def batch_of(jobs):
+    ' one batch job that prints all of jobs (which may be batches themselves), with the BatchOptions of the first if that was a batch '
+    parts = []
+    for kind, data, option in jobs:
+        parts.extend( data  if kind == 'batch'  else  [(kind, data, option)] )
+    return 'batch', tuple(parts), ( jobs[0][2]  if jobs[0][0] == 'batch'  else  BatchOptions() )
+
+
+@functools.lru_cache(maxsize=16)
+def separator_image(separator, gap):
+    ' what goes between the parts of a batch: gap rows, with a line or dashes across the middle (unless separator is blank) '
+    image = PIL.Image.new('1', (PrinterWidth, gap), 1)
+    if separator != 'blank'  and  gap >= 2:
+        draw = PIL.ImageDraw.Draw(image)
+        for x in range(0, PrinterWidth, 16 if separator == 'dashed' else PrinterWidth):
+            draw.rectangle( (x, gap//2 - 1, x + (7 if separator == 'dashed' else PrinterWidth), gap//2), fill=0 )
+    return image
+
+
+def get_job_executor():
+    ' the thread or process pool that prepare_job runs in, created on first use '
+    global job_executor
+    if job_executor is None:
+        if job_executor_kind == 'process':
+            job_executor = concurrent.futures.ProcessPoolExecutor(max_workers=job_workers)
+        else:
+            job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix='catprint-job')
+    return job_executor
+
+
+def job_energy(kind, data=None):
+    ' text prints fine with less energy (a batch gets what its darkest part needs;  a compiled job has it in its file) '
+    if kind == 'compiled':
+        return None
+    if kind == 'batch':
+        return max( job_energy(part_kind)  for part_kind, _, _ in data )
+    return 17000 if kind == 'text' else 0x7EE0
+
+
+def job_cache_key(kind, data, option, model):
+    ' hash of everything that decides what a job encodes to '
+    h = hashlib.sha256()
+    h.update( repr( (kind, option, job_energy(kind, data), model, density_profiles.get(model), collapse_blank_rows, band_height) ).encode('utf8') )
+    hash_job_data(h, data)
+    return h.hexdigest()
+
+
+def hash_job_data(h, data):
+    ' feeds job data (text, file bytes, a SpooledUpload, or the parts of a batch) to hash object h '
+    if isinstance(data, SpooledUpload):
+        with open(data.path, 'rb') as f:
+            for block in iter( functools.partial(f.read, 1024*1024), b'' ):
+                h.update(block)
+    elif isinstance(data, tuple):
+        for part_kind, part_data, part_option in data:
+            h.update( repr( (part_kind, part_option) ).encode('utf8') )
+            hash_job_data(h, part_data)
     else:
-        pil_or_bytes = io.BytesIO(pil_or_bytes)
-        image = PIL.Image.open(pil_or_bytes)
-        # deal with possible transparency by pasting it on white (TODO: put this on 'is there an alpha channel' condition)
+        h.update( data.encode('utf8')  if isinstance(data, str)  else  data )
+
+
+class JobCache:
+    """ Remembers the encoded commands of recent jobs, least recently used goes first once max_bytes is exceeded.
+        Only used from the bluetooth loop, so no locking.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries   = collections.OrderedDict()
+        self.size      = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def get(self, key):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes // 4: # one huge banner shouldn't push out everything else
+            return
+        if key in self.entries:
+            self.size -= len( self.entries.pop(key) )
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        return {"cache_hits":self.hits, "cache_misses":self.misses, "cache_evictions":self.evictions,
+                "cache_entries":len(self.entries), "cache_bytes":self.size}
+
+
+job_cache = JobCache(job_cache_bytes)
+
+
+def cache_while_sending(key, chunks):
+    ' passes chunks through, and once all of them went through, puts them in job_cache (unless they get too large to be worth it) '
+    kept, size = [], 0
+    for chunk in chunks:
+        if kept is not None:
+            size += len(chunk)
+            if size > job_cache.max_bytes // 4:
+                kept = None
+            else:
+                kept.append( bytes(chunk) )
+        yield chunk
+    if kept is not None:
+        job_cache.put(key, b''.join(kept))
+
+
+job_priorities = {'urgent':0, 'normal':1, 'low':2}
+
+class JobJournal:
+    """ Append-only file of the jobs we accepted, so that a restart or crash doesn't lose the ones not printed yet.
+        A record is a header (type, job id, payload length), the payload, and a CRC32 of both,
+        so that a record cut off by a crash gets recognized, and dropped along with anything after it.
+        An accepted job's payload is everything needed to redo it: kind, option, priority, printer pin, and the text or file itself
+        (for a batch, each part's kind, option, and text or file).
+
+        accepted() only returns once its record is on disk.  Submitters that arrive while an fsync is going on
+        wait for the next one, which then covers all of them, so many submitting at once doesn't mean an fsync each.
+        done() records are not synced (after a crash, the worst case is printing something twice).
+        Whenever nothing is pending the file gets emptied, and open() rewrites it to just the pending jobs.
+    """
+    magic    = b'CATJOBS1'
+    header   = struct.Struct('<BQI')  # record type, job id, payload length
+    trailer  = struct.Struct('<I')    # crc32 of header and payload
+    meta     = struct.Struct('<H')    # accepted: length of the JSON with everything but the data, which follows it
+    Accepted, Done = 1, 2
+
+    def __init__(self, path):
+        self.path    = path
+        self.file    = None
+        self.lock    = threading.Lock()       # for writing to the file
+        self.synced  = threading.Condition()  # for the below
+        self.written = 0                      # accepted records written
+        self.durable = 0                      # how many of those are known to be on disk
+        self.syncing = False
+        self.fsyncs  = 0
+        self.pending = set()                  # ids of accepted jobs not done yet
+
+    def open(self):
+        """ Reads what the file has pending from last time, and rewrites it to only that.
+            Returns [(job id, job, priority, printer)] of those, in the order they were accepted.
+        """
+        jobs = collections.OrderedDict()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                if f.read(len(self.magic)) != self.magic:
+                    raise ValueError('%s is not a job journal'%self.path)
+                for kind, job_id, payload in self.read_records(f):
+                    if kind == self.Accepted:
+                        jobs[job_id] = self.decode_job(payload)
+                    else:
+                        jobs.pop(job_id, None)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.magic)
+            for job_id, (job, priority, printer) in jobs.items():
+                self.write_accepted(f, job_id, job, priority, printer)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.file = open(self.path, 'ab')
+        self.pending = set(jobs)
+        return [ (job_id, job, priority, printer)  for job_id, (job, priority, printer) in jobs.items() ]
+
+    def read_records(self, f):
+        ' yields (type, job id, payload) of the intact records in f, stopping at the first that is not '
+        while 1:
+            header = f.read(self.header.size)
+            if len(header) < self.header.size:
+                return
+            kind, job_id, length = self.header.unpack(header)
+            payload = f.read(length)
+            trailer = f.read(self.trailer.size)
+            if len(trailer) < self.trailer.size  or  self.trailer.unpack(trailer)[0] != zlib.crc32(payload, zlib.crc32(header)):
+                log.warning('%s: dropping the end of the journal, which got cut off', self.path)
+                return
+            yield kind, job_id, payload
+
+    def decode_job(self, payload):
+        ' an Accepted payload back into (job, priority, printer) '
+        (meta_length,) = self.meta.unpack_from(payload)
+        meta = json.loads( payload[self.meta.size:self.meta.size+meta_length] )
+        data = payload[self.meta.size+meta_length:]
+        if meta['kind'] == 'batch': # the parts' data one after the other, their lengths in meta
+            parts, offset = [], 0
+            for kind, option, length in meta['parts']:
+                parts.append( self.decode_part(kind, data[offset:offset+length], option) )
+                offset += length
+            job = ('batch', tuple(parts), BatchOptions(*meta['option']))
+        else:
+            job = self.decode_part(meta['kind'], data, meta['option'])
+        return job, meta['priority'], meta['printer']
+
+    def decode_part(self, kind, data, option):
+        if kind in ('text', 'compiled'):
+            return kind, data.decode('utf8'), option
+        if len(data) > spool_upload_bytes:
+            data = spool_upload( io.BytesIO(data) )
+        return kind, data, ImageOptions(*option)
+
+    def write_accepted(self, f, job_id, job, priority, printer):
+        kind, data, option = job
+        parts = data  if kind == 'batch'  else  [job]
+        pieces = [ part_data.encode('utf8')  if isinstance(part_data, str)  else  part_data   for _, part_data, _ in parts ]
+        lengths = [ piece.size  if isinstance(piece, SpooledUpload)  else  len(piece)   for piece in pieces ]
+        meta = {'kind':kind, 'option':option, 'priority':priority, 'printer':printer}
+        if kind == 'batch':
+            meta['parts'] = [ [part_kind, part_option, length]  for (part_kind, _, part_option), length in zip(parts, lengths) ]
+        meta = json.dumps(meta).encode('utf8')
+        header = self.header.pack(self.Accepted, job_id, self.meta.size + len(meta) + sum(lengths))
+        crc = zlib.crc32( self.meta.pack(len(meta)) + meta, zlib.crc32(header) )
+        f.write(header)
+        f.write(self.meta.pack(len(meta)) + meta)
+        for piece in pieces:
+            if isinstance(piece, SpooledUpload):
+                with open(piece.path, 'rb') as upload:
+                    for block in iter( functools.partial(upload.read, 1024*1024), b'' ):
+                        crc = zlib.crc32(block, crc)
+                        f.write(block)
+            else:
+                crc = zlib.crc32(piece, crc)
+                f.write(piece)
+        f.write( self.trailer.pack(crc) )
+
+    def accepted(self, job_id, job, priority, printer):
+        ' records a job, returns once that is on disk '
+        with self.lock:
+            self.write_accepted(self.file, job_id, job, priority, printer)
+            self.file.flush()
+            self.pending.add(job_id)
+            self.written += 1
+            mine = self.written
+        with self.synced:
+            while self.durable < mine:
+                if self.syncing: # someone else's fsync is under way, the next one will include ours
+                    self.synced.wait()
+                    continue
+                self.syncing = True
+                with self.lock:
+                    upto = self.written
+                self.synced.release()
+                try:
+                    os.fsync(self.file.fileno())
+                    self.fsyncs += 1
+                finally:
+                    self.synced.acquire()
+                    self.syncing = False
+                    self.synced.notify_all()
+                self.durable = max(self.durable, upto)
+
+    def done(self, job_id):
+        ' records that a job was printed (or failed), so that it is not redone '
+        with self.lock:
+            if job_id not in self.pending:
+                return
+            self.pending.discard(job_id)
+            if self.pending:
+                header = self.header.pack(self.Done, job_id, 0)
+                self.file.write( header + self.trailer.pack(zlib.crc32(header)) )
+                self.file.flush()
+            else: # nothing left that we could need: start over
+                self.file.truncate( len(self.magic) )
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class JobQueue:
+    """ Print jobs waiting for the bluetooth loop, as (kind, data, option) tuples like prepare_job takes.
+        submit() can be called from any thread (e.g. the web server's), printers pop and wait for work with wait(),
+        which wakes up as soon as something is submitted.
+        Lower priority numbers go first, and within a priority it's first come first served.
+        Jobs can be pinned to a printer (see Printer.matches), which pop() leaves to that printer.
+        Each gets an id, which with open_journal is also how the JobJournal knows it, until done().
+    """
+    def __init__(self, max_jobs):
+        self.max_jobs = max_jobs
+        self.heap     = []
+        self.lock     = threading.Lock()
+        self.counter  = itertools.count() # keeps the order within a priority, and avoids comparing jobs
+        self.ids      = itertools.count(1)
+        self.loop     = None
+        self.wakeup   = None
+        self.journal  = None
+        self.journaling = 0               # submits that are writing to the journal, and count towards max_jobs
+
+    def open_journal(self, path):
+        ' from now on, keep accepted jobs in a JobJournal at path - starting with what it still had from last time '
+        journal = JobJournal(path)
+        replayed = journal.open()
+        with self.lock:
+            for job_id, job, priority, printer in replayed:
+                heapq.heappush(self.heap, (priority, next(self.counter), job, printer, time.perf_counter(), job_id))
+            self.ids = itertools.count( max( [job_id  for job_id, *_ in replayed], default=0 ) + 1 )
+            self.journal = journal
+        if replayed:
+            log.info('%d jobs left over from last time, queued again', len(replayed))
+            self.wake()
+
+    def bind(self, loop):
+        ' called from the loop that will consume jobs '
+        self.loop   = loop
+        self.wakeup = asyncio.Event()
+        if len(self) > 0:
+            self.wakeup.set()
+
+    def submit(self, job, priority=job_priorities['normal'], printer=None):
+        """ add a job, optionally pinned to a printer, and return its id.  Raises asyncio.QueueFull if there are already max_jobs waiting.
+            With a journal, returns once the job is in there (so this is best not called from the event loop)
+        """
+        with self.lock:
+            if len(self.heap) + self.journaling >= self.max_jobs:
+                raise asyncio.QueueFull()
+            job_id = next(self.ids)
+            journal = self.journal
+            self.journaling += 1
         try:
-            new_image = PIL.Image.new("RGBA", image.size, "WHITE")
-            new_image.paste(image, (0, 0), image)    
-            image = new_image
-        except:
-            pass # ?    
-        return image
+            if journal is not None:
+                journal.accepted(job_id, job, priority, printer)
+        finally:
+            with self.lock:
+                self.journaling -= 1
+        with self.lock:
+            heapq.heappush(self.heap, (priority, next(self.counter), job, printer, time.perf_counter(), job_id))
+        self.wake()
+        return job_id
+
+    def pop(self, accepts=None, kinds=None):
+        """ returns (the job that should go next, seconds it waited, its id), or None if there is none.
+            accepts, if given, is called with each job's printer pin (None if not pinned), and decides whether the caller can take it.
+            kinds, if given, only considers jobs of those kinds
+        """
+        with self.lock:
+            if accepts is None  and  kinds is None:
+                entry = heapq.heappop(self.heap)  if self.heap  else None
+            else:
+                entry = min( (entry  for entry in self.heap  if (accepts is None or accepts(entry[3]))  and  (kinds is None or entry[2][0] in kinds)), default=None )
+                if entry is not None:
+                    self.heap.remove(entry)
+                    heapq.heapify(self.heap)
+        if entry is None:
+            return None
+        return entry[2], time.perf_counter() - entry[4], entry[5]
+
+    def done(self, *job_ids):
+        ' popped jobs were printed, or failed: the journal can forget them '
+        if self.journal is not None:
+            for job_id in job_ids:
+                self.journal.done(job_id)
+
+    def wake(self):
+        ' make wait() return - because there is a new job, or something else the loop should look at. Thread-safe '
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def wait(self, timeout):
+        ' wait until woken, or at most timeout seconds '
+        with contextlib.suppress(asyncio.TimeoutError):
+            await wait_for(self.wakeup.wait(), timeout)
+        self.wakeup.clear()
+
+    def counts(self):
+        ' amount of waiting jobs per kind '
+        with self.lock:
+            return collections.Counter( entry[2][0]  for entry in self.heap )
+
+    def __len__(self):
+        return len(self.heap)
+
+
+job_queue = JobQueue(max_queued_jobs)
+
+
+class Histogram:
+    """ Prometheus-style histogram: per label set, how many observations fell at or under each bucket's upper bound, plus their sum.
+        observe() can be called from any thread.
+    """
+    def __init__(self, name, help, buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)):
+        self.name    = name
+        self.help    = help
+        self.buckets = buckets
+        self.series  = {}  # sorted label items -> [count per bucket..., +Inf count, sum]
+        self.lock    = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                counts = self.series[key] = [0]*(len(self.buckets)+2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def exposition(self):
+        lines = [ '# HELP %s %s'%(self.name, self.help), '# TYPE %s histogram'%self.name ]
+        with self.lock:
+            for key, counts in sorted(self.series.items()):
+                for bound, count in zip( self.buckets+('+Inf',), counts ):
+                    lines.append( '%s_bucket%s %d'%(self.name, metric_labels(key + (('le', bound),)), count) )
+                lines.append( '%s_sum%s %s'%(self.name, metric_labels(key), repr(float(counts[-1]))) )
+                lines.append( '%s_count%s %d'%(self.name, metric_labels(key), counts[-2]) )
+        return lines
+
+
+class Counter:
+    ' Prometheus-style counter (or, with set(), a gauge), per label set '
+    def __init__(self, name, help, type='counter'):
+        self.name   = name
+        self.help   = help
+        self.type   = type
+        self.series = collections.Counter()
+        self.lock   = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        with self.lock:
+            self.series[ tuple(sorted(labels.items())) ] += amount
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.series[ tuple(sorted(labels.items())) ] = value
+
+    def exposition(self):
+        lines = [ '# HELP %s %s'%(self.name, self.help), '# TYPE %s %s'%(self.name, self.type) ]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append( '%s%s %s'%(self.name, metric_labels(key), value) )
+        return lines
+
+
+def metric_labels(items):
+    ' {name="value",...} for the exposition format '
+    if not items:
+        return ''
+    return '{%s}'%','.join( '%s="%s"'%(name, str(value).replace('\\', r'\\').replace('"', r'\"'))  for name, value in items )
+
+
+job_stage_seconds    = Histogram('catprint_job_stage_seconds',    'Time each print job spent per stage (queue_wait, decode or render, prepare, encode, transmit)')
+ble_write_seconds    = Histogram('catprint_ble_write_seconds',    'Time a single write to the printer took')
+status_rtt_seconds   = Histogram('catprint_status_rtt_seconds',   'Time from asking the printer for its status to getting the answer')
+scan_duration        = Histogram('catprint_scan_seconds',         'Time spent per bluetooth scan')
+ble_bytes            = Counter('catprint_ble_bytes_total',        'Bytes sent to the printer')
+ble_bytes_per_sec    = Counter('catprint_ble_bytes_per_second',   'Throughput of the last larger send to the printer', type='gauge')
+jobs_total           = Counter('catprint_jobs_total',             'Print jobs, by kind and outcome')
+connects_total       = Counter('catprint_connects_total',         'Connections made to a printer, by how it was found')
+connection_lost      = Counter('catprint_connection_lost_total',  'Connections that ended')
+scans_total          = Counter('catprint_scans_total',            'Bluetooth scans, by whether they found the printer')
+job_rss_bytes        = Counter('catprint_job_rss_bytes',          'Most resident memory seen while preparing the last job, by kind', type='gauge')
+
+def finish_job_trace(trace):
+    ' a job was sent: count it, put its per-stage times in the histograms, (with job_trace_file) log them, and tell the job queue it is done '
+    for stage in ('queue_wait', 'load', 'decode', 'render', 'prepare', 'encode', 'transmit'):
+        if stage in trace:
+            job_stage_seconds.observe(trace[stage], stage=stage)
+    jobs_total.inc(kind=trace['kind'], outcome='printed')
+    if 'rss_bytes' in trace:
+        job_rss_bytes.set(trace['rss_bytes'], kind=trace['kind'])
+    trace_log.info( json.dumps(trace) )
+    job_queue.done( trace['job'], *trace.get('coalesced', ()) )
+    status_feed.job(trace, 'printed')
+
+
+def traced(chunks, trace):
+    """ Passes a job's command chunks through, noting in trace how long it took to make them (encode), 
+        and how much longer it took from the first to the last (transmit, since that is what we wait on in between).
+        Then calls finish_job_trace
+    """
+    encode, started = 0.0, time.perf_counter()
+    trace['bytes'] = 0
+    chunks = iter(chunks)
+    while 1:
+        t0 = time.perf_counter()
+        chunk = next(chunks, None)
+        encode += time.perf_counter() - t0
+        if chunk is None:
+            break
+        trace['bytes'] += len(chunk)
+        yield chunk
+    trace['encode'] = encode
+    trace['transmit'] = time.perf_counter() - started - encode
+    finish_job_trace(trace)
+
+
+def compiled_entries(jobs, trace):
+    """ The command_queue entries that print CompiledJobs (from one 'compiled' job) as one session: 
+        a single retract and feed around all of them, and one entry per file, so stop-and-wait checks status once per file rather than three times.
+        They share one traced(), which the last entry finishes
+    """
+    head, between, tail = [ list(drawcommand_bands(None, feed_amount=amount))  for amount in (-50, 60-50, 60) ]
+    prefixes = [head] + [between]*(len(jobs)-1)
+    chunks = traced( itertools.chain( itertools.chain.from_iterable( prefix + list(job.chunks())  for prefix, job in zip(prefixes, jobs) ), tail ), trace )
+    return [ itertools.islice(chunks, len(prefix) + 1)  for prefix in prefixes[:-1] ] + [chunks]
+
+
+class StreamedPrint:
+    """ A command_queue entry for a job at least stream_rows high, which Printer.send_streamed sends a band at a time 
+        (encoding the next band while this one goes out), asking for status after each band.
+        The printer answers those in order, so we know which bands it got.  When an answer says it is out of paper, open, or too hot,
+        we stop within a band, and once it is fine again (or we reconnected after losing it) we go on from the first band it did not confirm.
+        The retract before and the feed after are entries of their own, as for other jobs.
+    """
+    problems = ('no_paper', 'cover_open', 'over_temp') # PrinterStatus fields that mean we should not be printing
+
+    def __init__(self, image, trace, model):
+        self.image     = image  # from prepare_job
+        self.trace     = trace
+        self.model     = model
+        self.bands     = math.ceil(image.height / band_height)
+        self.confirmed = 0      # bands (counting in the order they print) the printer got, and answered a status request after without a problem
+        self.stopped   = None   # the problem, while we wait for it to go away
+        self.stops     = 0
+
+    def __repr__(self):
+        return '<StreamedPrint job %s, %d of %d bands%s>'%(self.trace['job'], self.confirmed, self.bands, ', stopped: '+self.stopped  if self.stopped  else '')
+
+    def problem(self, status):
+        ' the first of problems that a PrinterStatus (or None, when we do not know yet) shows, or None '
+        if status is None:
+            return None
+        return next( (name  for name in self.problems  if getattr(status, name)), None )
 
 
 ########################### bluetooth and printer related
 
 # CRC8 table extracted from APK, pretty standard though
-def crc8(data):
-    crc8_table = [
+Crc8Table = bytes([
         0x00, 0x07, 0x0e, 0x09, 0x1c, 0x1b, 0x12, 0x15, 0x38, 0x3f, 0x36, 0x31,
         0x24, 0x23, 0x2a, 0x2d, 0x70, 0x77, 0x7e, 0x79, 0x6c, 0x6b, 0x62, 0x65,
         0x48, 0x4f, 0x46, 0x41, 0x54, 0x53, 0x5a, 0x5d, 0xe0, 0xe7, 0xee, 0xe9,
@@ -166,13 +1157,40 @@ def crc8(data):
         0xb2, 0xb5, 0xbc, 0xbb, 0x96, 0x91, 0x98, 0x9f, 0x8a, 0x8d, 0x84, 0x83,
         0xde, 0xd9, 0xd0, 0xd7, 0xc2, 0xc5, 0xcc, 0xcb, 0xe6, 0xe1, 0xe8, 0xef,
         0xfa, 0xfd, 0xf4, 0xf3
-    ]
+])
 
 
+def crc8(data):
     crc = 0
     for byte in data:
-        crc = crc8_table[(crc ^ byte) & 0xFF]
-    return crc & 0xFF
+        crc = Crc8Table[crc ^ byte]
+    return crc
+
+
+crc8_position_tables = {} # message length -> list of translate() tables, see crc8_rows
+
+def crc8_rows(data, length):
+    """ CRC8 of each length-sized piece of data, returned as bytes (one per piece).
+
+        This CRC is linear (no init or final XOR), so a message's CRC is the XOR of what each byte contributes on its own,
+        and for a fixed length that contribution only depends on the byte's position.
+        That means one translate() per column of all pieces at once, XORed together as big ints, all at C speed,
+        rather than a python loop per byte per piece.
+    """
+    count = len(data) // length
+    tables = crc8_position_tables.get(length)
+    if tables is None:
+        # the last byte contributes Crc8Table[byte], and each byte before that gets pushed through the table once more
+        tables = [Crc8Table]
+        while len(tables) < length:
+            tables.append( tables[-1].translate(Crc8Table) )
+        tables.reverse()
+        crc8_position_tables[length] = tables
+    data = bytes(data)
+    crcs = 0
+    for pos, table in enumerate(tables):
+        crcs ^= int.from_bytes(data[pos::length].translate(table), 'little')
+    return crcs.to_bytes(count, 'little')
 
 
 def format_message(command, data):
@@ -185,321 +1203,1514 @@ def format_message(command, data):
     # Data: Data Length bytes
     # CRC8 of Data: 1 byte
     # 0xFF
-    data = [ 0x51, 0x78 ] + [command] + [0x00] + [len(data)] + [0x00] + data + [crc8(data)] + [0xFF]
-    return bytes(data)
-
-
-async def request_printer_status():
-    ''' periodically queue statues request to the printer (also keeping it awake?), 
-        This will be run alongside  connect_catprinter_and_handle_queues
-
-        These seem to not be sent out (so no notifs received either) while printing, 
-        so either fix that, or pause queueing these while sending a print.
-    '''
-    global command_queue
-    while 1:
-        # CONSIDER: ensure a limit of these on the queue, to avoid an initial stampede when you turn it on later
-        command_queue.append( format_message(GetDevState, [0x00]) + format_message(ControlLattice, FinishLattice) )
-        #if device is None:
-        await asyncio.sleep(4)
-        #else:
-        #    await asyncio.sleep(1)
-
-
-def catprinter_notification_handler(sender, data):
-    " 'got a notification from the printer' callback: parse, and update some globals "
-    global status, awaiting_status, last_communication
-    #print("NOTIF: {0}: [ {1} ]".format(sender, " ".join("{:02X}".format(x) for x in data)))
-    # XOff = ( 0x51, 0x78, 0xAE, 0x01, 0x01, 0x00, 0x10, 0x70, 0xFF )
-    # XOn = ( 0x51, 0x78, 0xAE, 0x01, 0x01, 0x00, 0x00, 0x00, 0xFF )
-    
-    # The code I took this from tests of xon and xoff, but those never seem to be received
-    if data[2] == GetDevState:
-        awaiting_status = False
-        #print("printer status byte: {:08b}".format(data[6]))
-        status = {
-            # different models seem to use different subets. cover_open doesn't work on my MX06, other code had a note that low battery is the only one GB01 uses.
-            "no_paper":    True if data[6] & 0b00000001 else False,
-            "cover_open":  True if data[6] & 0b00000010 else False, # doesn't seem to work on all models?
-            "over_temp":   True if data[6] & 0b00000100 else False,
-            "battery_low": True if data[6] & 0b00001000 else False,
-            "printing":    True if data[6] & 0b10000000 else False, # I'm guessing this one.  Who knows, might be a xoff thing?
-        }
-        if data[6] & 0b01110000: # bits we don't know yet
-            print('unknown bits: ', data[6])
-    last_communication = time.time()
-
-
-def detect_catprinter(detected, advertisement_data):
-    global device
-    # This isn't necessarily a great way to detect the printer.
-    # It's the way the app does it, but the app has an actual UI where you can pick your device from a list.
-    # Ideally this function would filter for known characteristics, but I don't know how hard that would be or what
-    # kinds of problems it could cause. For now, I just want to get my printer working.
-    if detected.name in accepted_printer_names:
-        device = detected
-
-
-async def connect_catprinter_and_handle_queues():
-    ' infinitely loop "scan for printer and connect to the first that is found; while connected, handle queues" '
-    global device, command_queue, text_queue, awaiting_status, last_communication, bluetooth_on
-
-    while 1:
-        #print('while loop')
-        try:
-
-            # Scan for BLE devices (up to 5 seconds each time), see if we find one called MX06
-            print("scan for printer")
+    data = bytes(data)
+    return bytes([ 0x51, 0x78, command, 0x00, len(data), 0x00 ]) + data + bytes([ crc8(data), 0xFF ])
+
+
+def format_messages(command, data, length, out=None, offset=0):
+    """ Batch version of format_message: frames each length-sized piece of data as its own message (e.g. one DrawBitmap per row).
+        Writes into out (a bytearray with room for len(data)//length*(length+8) bytes from offset on), 
+        or into a new bytearray if you don't give one.  Returns that bytearray.
+
+        Works column-wise with extended slice assignment, so the work per call doesn't really grow with the amount of pieces.
+    """
+    count = len(data) // length
+    framelen = length + 8
+    if out is None:
+        out, offset = bytearray(count * framelen), 0
+    end = offset + count * framelen
+    for pos, byte in enumerate( (0x51, 0x78, command, 0x00, length, 0x00) ):
+        out[offset+pos:end:framelen] = bytes([byte]) * count
+    for pos in range(length):
+        out[offset+6+pos:end:framelen] = data[pos:count*length:length]
+    out[offset+6+length:end:framelen] = crc8_rows(data, length)
+    out[offset+7+length:end:framelen] = b'\xFF' * count
+    return out
+
+
+StatusRequest = format_message(GetDevState, [0x00]) # which the printer answers with a notification, see PrinterStatus
+
+
+class PrinterStatus:
+    ' What a GetDevState notification tells us. Different models seem to use different subsets of these bits '
+    fields = ('no_paper', 'cover_open', 'over_temp', 'battery_low', 'printing')
+
+    def __init__(self, byte):
+        self.byte        = byte
+        self.no_paper    = bool(byte & 0b00000001)
+        self.cover_open  = bool(byte & 0b00000010) # doesn't work on my MX06, maybe not on all models?
+        self.over_temp   = bool(byte & 0b00000100)
+        self.battery_low = bool(byte & 0b00001000) # other code had a note that low battery is the only one GB01 uses.
+        self.printing    = bool(byte & 0b10000000) # I'm guessing this one.  Who knows, might be a xoff thing?
+        self.received    = time.time()
+        if byte & 0b01110000: # bits we don't know yet
+            log.warning('unknown status bits: %s', format(byte, '08b'))
+
+    def as_dict(self):
+        return { name:getattr(self, name)  for name in self.fields }
+
+    def __repr__(self):
+        return '<PrinterStatus %s %s>'%( format(self.byte, '08b'), ' '.join(name  for name in self.fields  if getattr(self, name)) )
+
+
+KnownDevice = collections.namedtuple('KnownDevice', 'address name') # stands in for a BLEDevice when we connect by address
+
+
+def load_known_printers():
+    ' returns {address:name} from known_printers_file, most recently used last '
+    try:
+        with open(known_printers_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.warning("could not read %s (%s), ignoring it", known_printers_file, e)
+        return {}
+
+
+def remember_printer(device):
+    ' note down a printer we connected to, so that next time we can connect to it directly instead of scanning '
+    known = load_known_printers()
+    known.pop(device.address, None) # so that it moves to the end
+    known[device.address] = device.name
+    try:
+        with open(known_printers_file+'.tmp', 'w') as f:
+            json.dump(known, f, indent=1)
+        os.replace(known_printers_file+'.tmp', known_printers_file)
+    except OSError as e:
+        log.warning("could not write %s (%s)", known_printers_file, e)
+
+
+@contextlib.asynccontextmanager
+async def disconnecting(transport):
+    ' like async with BleakClient(...), for a transport that Printer.run already connected '
+    try:
+        yield transport
+    finally:
+        await transport.disconnect()
+
+
+class BleakTransport:
+    """ Talks to a real printer over bluetooth LE, with bleak.
+
+        This is one of the things a Printer can talk to (see printer_transport), SimulatedPrinter is the other. Both have:
+          await connect()              find the printer and connect to it. Returns the device (something with .name and .address),
+                                       raises BleakError (SimulatedPrinterError) if it could not be found.  .connected_how says how that went.
+                                       (bleak gets imported then, rather than when this module is)
+          await start_notify(handler)  have handler(data) called with each notification from the printer, from whatever thread
+          await write(data, response)  send bytes. response=None is whatever the backend does by default
+          await disconnect()
+          packet_size()                how much to send per write on this connection
+          can_write_without_response()
+    """
+    def __init__(self, printer):
+        self.printer        = printer
+        self.client         = None
+        self.connected_how  = None
+        self.scan_failures  = 0     # scans in a row that did not find it, for the backoff
+        self.next_scan      = 0     # time.time() before which we should not scan again
+
+    def detect(self, detected, advertisement_data):
+        ' BleakScanner callback '
+        # This isn't necessarily a great way to detect the printer.
+        # It's the way the app does it, but the app has an actual UI where you can pick your device from a list.
+        # Ideally this function would filter for known characteristics, but I don't know how hard that would be or what
+        # kinds of problems it could cause. For now, I just want to get my printer working.
+        if self.printer.device is None  and  self.printer.wants(detected.name, detected.address):
+            self.printer.device = detected
+
+    def known_devices(self):
+        ' the printers from known_printers_file that could be this one, most recently used first '
+        return [ KnownDevice(address, name)  for address, name in reversed(list(load_known_printers().items()))  if self.printer.wants(name, address) ]
+
+    async def scan(self):
+        """ Scan for BLE devices for up to scan_seconds, stopping as soon as we see ours. 
+            One scan at a time, when there are multiple printers
+        """
+        global bluetooth_on
+        from bleak import BleakScanner
+        async with scan_lock:
+            log.info("%r: scan for printer", self.printer)
             try:
                 # in earlier bleak versions:
                 scanner = BleakScanner( )
-                scanner.register_detection_callback( detect_catprinter )
+                scanner.register_detection_callback( self.detect )
             except Exception as e:
                 # now:
-                scanner = BleakScanner( detect_catprinter )
+                scanner = BleakScanner( self.detect )
 
+            t0 = time.perf_counter()
             await scanner.start()
             bluetooth_on = True
-            for x in range(50): # 
-                await asyncio.sleep(0.1)
-                if device:
-                    break
+            deadline = time.time() + scan_seconds
+            while self.printer.device is None  and  time.time() < deadline:
+                await asyncio.sleep(0.05)
             await scanner.stop()
-            if not device:
-                raise BleakError(f"No device named %s could be found."%(' or '.join(sorted(accepted_printer_names))))
-
-            last_communication = time.time()
-            # okay, we have a device to contact, do so:
-            async with BleakClient(device) as client:
-                #print('<client>')
+            scan_duration.observe( time.perf_counter() - t0 )
+            scans_total.inc( found=self.printer.device is not None )
+
+    async def connect(self):
+        """ Find the printer and connect to it: first directly at the addresses we connected to before (which takes about a second), 
+            and only if that fails by scanning.  Scans that find nothing make us wait longer (up to scan_backoff_max) before the next one,
+            but we keep trying the known addresses meanwhile, so a printer that wakes up is still picked up quickly.
+        """
+        from bleak import BleakClient
+        from bleak.exc import BleakError
+        printer = self.printer
+        while 1:
+            known_devices = self.known_devices()
+            for known in known_devices:
+                printer.device = known
+                self.client = BleakClient(known.address, timeout=direct_connect_timeout, disconnected_callback=printer.handle_disconnect)
                 try:
-                    # Set up callback to handle messages from the printer
-                    await client.start_notify(NotifyCharacteristic, catprinter_notification_handler)
-
-                    while 1:
-                        try:
-                            # we want to ensure a steady stream of status notification within the scope of a connection
-                            # (also if we care to listen to xoff and such, though that seems not to work?)
-                            #print( " waiting for notif in connection" )
-                            awaiting_status = True
-                            await client.write_gatt_char(PrinterCharacteristic, format_message(GetDevState, [0x00]) + format_message(ControlLattice, FinishLattice))
-                            while awaiting_status: # maybe timeout, otherwise this may be a hang-forver.
-                                ago_sec = time.time() - last_communication
-                                #print(ago_sec)
-                                if ago_sec > 10:
-                                    print("seem to have lost connection")
-                                    device = None
-                                    awaiting_status = False
+                    await self.client.connect()
+                    self.connected_how = 'direct'
+                    remember_printer(known)
+                    return known
+                except Exception as e:
+                    log.info("%r: could not connect directly (%s)", printer, str(e) or type(e).__name__)
+                    printer.device = None
+            wait = self.next_scan - time.time()
+            if wait <= 0:
+                break
+            await asyncio.sleep( min(wait, 1)  if known_devices  else wait )
+
+        await self.scan()
+        if not printer.device:
+            self.scan_failures += 1
+            self.next_scan = time.time() + min(scan_backoff_max, 2**(self.scan_failures-1))
+            raise BleakError(f"No device named %s could be found."%(printer.selector or ' or '.join(sorted(accepted_printer_names))))
+        self.scan_failures = 0
+        self.client = BleakClient(printer.device, disconnected_callback=printer.handle_disconnect)
+        try:
+            await self.client.connect()
+        except:
+            printer.device = None # maybe it went away again, or was never going to talk to us; look again next time
+            raise
+        self.connected_how = 'scan'
+        remember_printer(printer.device)
+        return printer.device
+
+    async def start_notify(self, handler):
+        await self.client.start_notify(NotifyCharacteristic, lambda sender, data: handler(data))
+
+    async def write(self, data, response=None):
+        if response is None:
+            await self.client.write_gatt_char(PrinterCharacteristic, data)
+        else:
+            await self.client.write_gatt_char(PrinterCharacteristic, data, response=response)
+
+    async def disconnect(self):
+        await self.client.disconnect()
+
+    def packet_size(self):
+        """ Pipelined, what the negotiated MTU allows (minus the 3-byte ATT header), otherwise the fixed packet_length
+        """
+        mtu = getattr(self.client, 'mtu_size', None) # not on all bleak backends/versions
+        if transfer_mode == 'pipelined' and mtu and mtu-3 >= 20:
+            return mtu - 3
+        return packet_length
+
+    def can_write_without_response(self):
+        ' whether the printer characteristic allows write-without-response '
+        try:
+            characteristic = self.client.services.get_characteristic(PrinterCharacteristic)
+            return characteristic is not None  and  'write-without-response' in characteristic.properties
+        except Exception:
+            return False
+
+
+class SimulatedPrinterError(Exception):
+    ' what a SimulatedPrinter raises where bleak would raise BleakError (with the same messages, which is what Printer.run goes by) '
+
+
+class SimulatedPrinter:
+    """ A printer that lives in this process, so that throughput, queueing, and what ends up on paper 
+        can be measured and tested without hardware.  Talks like BleakTransport (use printer_transport = 'simulated').
+
+        It takes what a real one takes: checks each message's framing and CRC, answers GetDevState, 
+        prints DrawBitmap / DrawCompressedBitmap rows and feeds paper at paper_speed rows per second 
+        (at ImgPrintSpeed, that is: slower or faster in proportion to the speed byte that OtherFeedPaper last set),
+        and sends XOff while more than buffer_rows rows wait to be printed (XOn once that is below half).
+        A write takes len/bandwidth seconds, and arrives latency seconds later (writes with response wait for that, and the acknowledgement).
+        image() gives what it printed so far.
+    """
+    def __init__(self, name='MX06', address='00:00:00:00:00:01', bandwidth=10000, latency=0.01, paper_speed=200, buffer_rows=1000,
+                       flow_control=True, mtu=185):
+        self.device        = KnownDevice(address, name)
+        self.bandwidth     = bandwidth     # bytes per second
+        self.latency       = latency       # seconds
+        self.paper_speed   = paper_speed   # rows per second
+        self.buffer_rows   = buffer_rows
+        self.flow_control  = flow_control
+        self.mtu           = mtu
+        self.available     = True          # set to False to have connect() fail, as if it were switched off
+        self.connected     = False
+        self.connected_how = None
+        self.handler       = None
+        self.status_byte   = 0x00          # what GetDevState answers, see PrinterStatus
+        self.received      = bytearray()   # not yet parsed, e.g. the start of a message split over writes
+        self.raster        = bytearray()   # what it printed: RowBytes per row, as in DrawBitmap
+        self.pending_rows  = 0             # rows received but not yet printed
+        self.pending       = collections.deque() # those as [rows, seconds per row], in the order they print
+        self.speed         = ImgPrintSpeed[0]  # what OtherFeedPaper last set
+        self.xoff          = False
+        self.printing      = None          # the task moving paper while there are pending_rows
+        self.stats         = collections.Counter()
+
+    def __repr__(self):
+        return '<SimulatedPrinter %s %s>'%(self.device.name, self.device.address)
+
+    async def connect(self):
+        if not self.available:
+            raise SimulatedPrinterError("No device named %s could be found."%self.device.name)
+        self.connected = True
+        self.connected_how = 'simulated'
+        if self.pending_rows > 0: # (paper that was still to move when we disconnected)
+            self.printing = asyncio.get_running_loop().create_task( self.move_paper() )
+        return self.device
+
+    async def start_notify(self, handler):
+        self.handler = handler
+
+    async def write(self, data, response=None):
+        if not self.connected:
+            raise SimulatedPrinterError("Not connected")
+        data = bytes(data)
+        self.stats['writes'] += 1
+        self.stats['bytes'] += len(data)
+        await asyncio.sleep( len(data) / self.bandwidth )
+        if response is False:
+            asyncio.get_running_loop().call_later(self.latency, self.receive, data)
+        else:
+            await asyncio.sleep( 2*self.latency )
+            self.receive(data)
+
+    async def disconnect(self):
+        ' stops moving paper too (connect goes on with it), so that no move_paper task outlives the event loop '
+        self.connected = False
+        self.handler = None
+        if self.printing is not None  and  not self.printing.done():
+            self.printing.cancel()
+            try:
+                await self.printing
+            except asyncio.CancelledError:
+                pass
+        self.printing = None
+
+    def packet_size(self):
+        return self.mtu-3  if transfer_mode == 'pipelined'  else  packet_length
+
+    def can_write_without_response(self):
+        return True
+
+    def notify(self, command, data):
+        ' send a notification, which arrives latency seconds later '
+        message = bytearray(format_message(command, data))
+        message[3] = 0x01 # notifications seem to have this set
+        if self.handler is not None:
+            asyncio.get_running_loop().call_later(self.latency, self.handler, bytes(message))
+
+    def receive(self, data):
+        ' data as it arrives: cut it into messages, check them, act on them '
+        received = self.received
+        received += data
+        while 1:
+            start = received.find(b'\x51\x78')
+            if start < 0:
+                self.stats['garbage_bytes'] += len(received) - (received[-1:] == b'\x51')
+                del received[:len(received) - (received[-1:] == b'\x51')]
+                return
+            if start > 0:
+                self.stats['garbage_bytes'] += start
+                del received[:start]
+            if len(received) < 6:
+                return
+            length = received[4] | received[5] << 8
+            if len(received) < length+8:
+                return
+            data = bytes(received[6:6+length])
+            if received[6+length] != crc8(data)  or  received[7+length] != 0xFF:
+                self.stats['bad_messages'] += 1
+                del received[:2] # and look for the next start
+                continue
+            command = received[2]
+            del received[:length+8]
+            self.stats['messages'] += 1
+            self.handle(command, data)
+
+    def handle(self, command, data):
+        ' one message '
+        self.stats['command_%02X'%command] += 1
+        if command == GetDevState:
+            self.notify(GetDevState, [ self.status_byte | (0x80 if self.pending_rows else 0x00) ])
+        elif command == DrawBitmap:
+            self.feed( data[:RowBytes].ljust(RowBytes, b'\x00') )
+        elif command == DrawCompressedBitmap:
+            pixels = ''.join( ('1' if byte & 0x80 else '0') * (byte & 0x7F)  for byte in data )[:PrinterWidth].ljust(PrinterWidth, '0')
+            self.feed( int(pixels[::-1], 2).to_bytes(RowBytes, 'little') )
+        elif command == FeedPaper:
+            self.feed( BlankRow * int.from_bytes(data[:2], 'little') )
+        elif command == RetractPaper:
+            self.stats['retracted_rows'] += int.from_bytes(data[:2], 'little') # doesn't take anything back off the raster
+        elif command == OtherFeedPaper:
+            self.speed = max(1, data[0])
+
+    def feed(self, rows):
+        ' rows (RowBytes each) go onto the paper, at paper_speed and the current speed byte.  stats["paper_seconds"] adds up how long that takes '
+        self.raster += rows
+        count, per_row = len(rows) // RowBytes, self.speed / (ImgPrintSpeed[0] * self.paper_speed)
+        if self.pending  and  self.pending[-1][1] == per_row:
+            self.pending[-1][0] += count
+        else:
+            self.pending.append( [count, per_row] )
+        self.pending_rows += count
+        self.stats['paper_seconds'] += count * per_row
+        if self.flow_control  and  not self.xoff  and  self.pending_rows > self.buffer_rows:
+            self.xoff = True
+            self.stats['xoff'] += 1
+            self.notify(FlowControl, [0x10])
+        if self.connected  and  (self.printing is None  or  self.printing.done()): # (writes without response can arrive after disconnect, see connect)
+            self.printing = asyncio.get_running_loop().create_task( self.move_paper() )
+
+    async def move_paper(self):
+        last, spare = time.perf_counter(), 0.0 # seconds of paper movement not used up by whole rows yet
+        while self.pending_rows > 0:
+            await asyncio.sleep(0.01)
+            now = time.perf_counter()
+            spare += now - last
+            last = now
+            while self.pending  and  spare >= self.pending[0][1]:
+                segment = self.pending[0]
+                rows = min( segment[0], max(1, int(spare / segment[1])) )
+                segment[0] -= rows
+                spare -= rows * segment[1]
+                self.pending_rows -= rows
+                if segment[0] == 0:
+                    self.pending.popleft()
+            if self.xoff  and  self.pending_rows < self.buffer_rows/2:
+                self.xoff = False
+                self.notify(FlowControl, [0x00])
+
+    def image(self):
+        ' what it printed so far, as a PIL image, turned the right way up again (we send images upside down, see drawcommand_bands) '
+        rows = len(self.raster) // RowBytes
+        if rows == 0:
+            return None
+        return PIL.Image.frombytes('1', (PrinterWidth, rows), bytes(self.raster).translate(RowByteTable)).transpose(PIL.Image.ROTATE_180)
+
+
+class Printer:
+    """ One printer that we keep connected to (see run), with its own commands, status, and statistics.
+        selector says which one: a MAC address, a name, or None for any with a name in accepted_printer_names.
+        Jobs come from the shared job_queue; a printer takes one when it is the least busy of the connected ones, 
+        or when the job was pinned to it.
+    """
+    def __init__(self, selector=None, transport=None):
+        self.selector           = selector
+        self.transport          = transport  if transport is not None  else  self.make_transport()
+        self.device             = None  # the BLEDevice (or KnownDevice), once found
+        self.status             = None  # PrinterStatus, from the last GetDevState notification
+        self.status_waiters     = []    # futures for request_status calls waiting on the next GetDevState notification
+        self.status_asked       = 0     # status requests sent this connection (each drawcommand_bands head is one)
+        self.status_answered    = 0     # and answers to them.  The printer answers in order, which is how a StreamedPrint knows which bands arrived
+        self.band_checks        = True  # whether the printer answers status requests while printing (see send_streamed); per connection, assumed until it does not
+        self.last_communication = time.time()
+        self.command_queue      = []    # iterables of bytes-like chunks, to be sent as-is, or StreamedPrints
+        self.preparing_jobs     = []    # (kind, task, trace) of jobs being prepared (see prepare), in the order they should print
+        self.flow_xon           = None  # asyncio.Event, per connection: cleared while the printer has told us XOff
+        self.connected          = False
+        self.transfer_stats     = {"bytes":0, "seconds":0.0, "last_bytes_per_sec":None}
+        self.jobs_done          = 0
+        self.looking_since      = time.time()  # when we lost it (or started), for time-to-first-print
+        self.connect_stats      = {"how":None, "connect_sec":None, "first_print_sec":None}
+        self.first_print_from   = None  # looking_since, while a job was waiting when we connected and has not been sent yet
+
+    def make_transport(self):
+        ' what printer_transport says we talk to '
+        if printer_transport == 'simulated':
+            name = self.selector  if self.selector in accepted_printer_names  else  accepted_printer_names[0]
+            return SimulatedPrinter(name, '00:00:00:00:00:%02X'%(len(printers)+1), **simulated_printer_options)
+        return BleakTransport(self)
+
+    def name(self):
+        ' for metrics labels: which printer this is, as far as we know '
+        return self.device.address  if self.device  else  self.selector or 'any'
+
+    def __repr__(self):
+        return '<Printer %s>'%(self.device.name+' '+self.device.address  if self.device  else  self.selector or 'any')
+
+    def matches(self, target):
+        ' whether target (as given when submitting a job) means this printer '
+        if target is None:
+            return True
+        target = target.upper()
+        return (  (self.selector is not None  and  target == self.selector.upper())  or
+                  (self.device is not None  and  target in (self.device.name.upper(), self.device.address.upper()))  )
+
+    def load(self):
+        ' how much this printer has on its plate, in jobs '
+        return len(self.preparing_jobs) + len(self.command_queue)//3
+
+    def accepts(self, target):
+        ' used with job_queue.pop: pinned jobs go to whoever they were pinned to, the rest to the least loaded connected printer '
+        if target is not None:
+            return self.matches(target)
+        return all( self.load() <= other.load()  for other in printers  if other.connected  and  other is not self )
+
+    def wants(self, name, address):
+        ' whether a device we see (or saw before) could be this printer, and is not already another one '
+        if name not in accepted_printer_names:
+            return False
+        if self.selector is not None  and  self.selector.upper() not in (name.upper(), address.upper()):
+            return False
+        return not any( other.device is not None  and  other.device.address == address  for other in printers  if other is not self )
+
+    def notification_handler(self, data):
+        """ 'got a notification from the printer' callback.  
+            Depending on the bleak backend that may not be called in our event loop's thread, so hand it to handle_notification there
+        """
+        #print("NOTIF: [ {0} ]".format(" ".join("{:02X}".format(x) for x in data)))
+        printer_loop.call_soon_threadsafe(self.handle_notification, bytes(data))
+
+    def handle_notification(self, data):
+        ' parse a notification from the printer, update our state, wake up whoever was waiting for it '
+        # XOff = ( 0x51, 0x78, 0xAE, 0x01, 0x01, 0x00, 0x10, 0x70, 0xFF )
+        # XOn = ( 0x51, 0x78, 0xAE, 0x01, 0x01, 0x00, 0x00, 0x00, 0xFF )
+        self.last_communication = time.time()
+        if len(data) < 7:
+            return
+
+        # The code I took this from tests of xon and xoff, but those never seem to be received (on an MX06, anyway)
+        if data[2] == FlowControl:
+            if self.flow_xon is not None:
+                if data[6] & 0x10:
+                    self.flow_xon.clear()
+                else:
+                    self.flow_xon.set()
+
+        elif data[2] == GetDevState:
+            self.status = PrinterStatus(data[6])
+            self.status_answered += 1
+            status_feed.changed()
+            while self.status_waiters:
+                waiter = self.status_waiters.pop(0)
+                if not waiter.done():
+                    waiter.set_result(self.status)
+
+    def handle_disconnect(self, client=None):
+        ' bleak disconnected_callback: fail whatever is waiting on the printer right away, rather than waiting for a timeout '
+        def fail_waiters():
+            while self.status_waiters:
+                waiter = self.status_waiters.pop(0)
+                if not waiter.done():
+                    waiter.set_exception( ConnectionError("Printer disconnected") )
+        printer_loop.call_soon_threadsafe(fail_waiters)
+
+    async def request_status(self):
+        """ Ask the printer for its status (also keeps it awake), and wait for the answer.
+            Returns a PrinterStatus; raises asyncio.TimeoutError if there was no answer within status_timeout seconds,
+            or ConnectionError if we got disconnected meanwhile.
+        """
+        waiter = printer_loop.create_future()
+        self.status_waiters.append(waiter)
+        try:
+            t0 = time.perf_counter()
+            self.status_asked += 1
+            await self.transport.write(StatusRequest + format_message(ControlLattice, FinishLattice))
+            status = await wait_for(waiter, status_timeout)
+            status_rtt_seconds.observe( time.perf_counter() - t0 )
+            log.debug("%r: %r", self, status)
+            return status
+        finally:
+            if waiter in self.status_waiters:
+                self.status_waiters.remove(waiter)
+
+    async def wait_answered(self, count, timeout=None):
+        """ wait until the printer answered count status requests (of this connection, see status_asked).
+            Raises like request_status, after timeout seconds (default status_timeout) without an answer
+        """
+        while self.status_answered < count:
+            waiter = printer_loop.create_future()
+            self.status_waiters.append(waiter)
+            try:
+                await wait_for(waiter, timeout or status_timeout)
+            finally:
+                if waiter in self.status_waiters:
+                    self.status_waiters.remove(waiter)
+
+    def counting_status_requests(self, chunks):
+        ' passes chunks through, counting those that start with a status request in status_asked '
+        for chunk in chunks:
+            if chunk[:len(StatusRequest)] == StatusRequest:
+                self.status_asked += 1
+            yield chunk
+
+    async def send_commands(self, chunks, packet_size, without_response=False):
+        """ Send one command_queue entry (an iterable of bytes-like chunks), cut into packet_size writes.
+            Pipelined this keeps writing (without response if without_response), stopping for the printer's XOff,
+            and waiting for an acknowledged write every pipeline_window packets, so that no more than that are ever in flight.
+            Otherwise it does what we always did: wait for each write, with a tiny pause in between.
+            Returns the amount of bytes sent, and adds to transfer_stats.
+        """
+        sent, t0 = 0, time.perf_counter()
+        for i, packet in enumerate(packetize(self.counting_status_requests(chunks), packet_size)):
+            if transfer_mode == 'pipelined':
+                if not self.flow_xon.is_set():
+                    try:
+                        await wait_for(self.flow_xon.wait(), xoff_timeout)
+                    except asyncio.TimeoutError:
+                        log.warning("%r: XOff for more than %s sec, sending anyway", self, xoff_timeout)
+                        self.flow_xon.set()
+                t1 = time.perf_counter()
+                await self.transport.write(packet, response=not without_response  or  i % pipeline_window == pipeline_window-1)
+                ble_write_seconds.observe( time.perf_counter() - t1 )
+            else:
+                t1 = time.perf_counter()
+                await self.transport.write(packet)
+                ble_write_seconds.observe( time.perf_counter() - t1 )
+                await asyncio.sleep(0.0001)
+            sent += len(packet)
+            self.last_communication = time.time()
+        took = time.perf_counter() - t0
+        self.transfer_stats["bytes"]   += sent
+        self.transfer_stats["seconds"] += took
+        ble_bytes.inc(sent, printer=self.name())
+        if sent > 1000: # the small ones (status requests, feeds) say little about throughput
+            self.transfer_stats["last_bytes_per_sec"] = round(sent / took)
+            ble_bytes_per_sec.set(round(sent / took), printer=self.name())
+            log.debug( "%r: sent %d bytes in %.2f sec, %.0f bytes/sec (%s)", self, sent, took, sent/took, transfer_mode )
+        return sent
+
+    async def send_streamed(self, job, packet_size, without_response=False):
+        """ Send a StreamedPrint, from the first band the printer did not confirm yet.
+            Before each band we look at the answers so far, waiting for the one about the band before last if need be,
+            so we are never more than a band ahead of what the printer told us.
+            (Unless it does not answer within band_status_timeout: then it gets the rest without waiting, see band_checks)
+            Returns True once all of it was sent and confirmed (and then finishes its trace),
+            or False when the printer reported a problem (job.stopped says which), after ending the lattice without the rest.
+        """
+        loop = asyncio.get_running_loop()
+        trace = job.trace
+        if job.confirmed > 0:
+            log.info("%r: going on with job %s from band %d of %d", self, trace['job'], job.confirmed+1, job.bands)
+        job.stopped = None
+        first = job.confirmed
+        chunks = drawcommand_bands(job.image, energy=trace['energy'], model=job.model, first_band=first)
+        asked = collections.deque() # (band, status_asked once we asked after it), for bands not confirmed yet
+
+        async def confirm(band, count):
+            ' wait for the answer after band, and see whether it means trouble '
+            if self.band_checks:
+                try:
+                    await self.wait_answered(count, band_status_timeout)
+                except asyncio.TimeoutError:
+                    log.warning("%r: no status while printing (waited %s sec), sending the rest without checks", self, band_status_timeout)
+                    self.band_checks = False
+            if not self.band_checks:
+                job.confirmed = band + 1
+                return True
+            job.stopped = job.problem(self.status)
+            if job.stopped:
+                job.stops += 1
+                log.warning("%r: printer says %s, stopped job %s after %d of %d bands", self, job.stopped, trace['job'], job.confirmed, job.bands)
+                status_feed.job(trace, 'stopped')
+                return False
+            job.confirmed = band + 1
+            return True
+
+        encode, started = 0.0, time.perf_counter()
+        pending = loop.run_in_executor(None, next, chunks, None)
+        try:
+            for i in itertools.count(): # chunk 0 is the head, then come the bands, then the tail
+                t0 = time.perf_counter()
+                chunk = await pending
+                encode += time.perf_counter() - t0
+                if chunk is None:
+                    break
+                pending = loop.run_in_executor(None, next, chunks, None) # encode the next band while this one goes out
+                while asked  and  (len(asked) > 1  or  self.status_answered >= asked[0][1]):
+                    if not await confirm(*asked.popleft()):
+                        await self.send_commands([drawcommand_tail()], packet_size, without_response)
+                        return False
+                if 1 <= i <= job.bands - first:
+                    await self.send_commands([chunk, StatusRequest], packet_size, without_response)
+                    asked.append( (first + i-1, self.status_asked) )
+                else:
+                    await self.send_commands([chunk], packet_size, without_response)
+                trace['bytes'] = trace.get('bytes', 0) + len(chunk)
+        finally:
+            pending.add_done_callback( lambda _: chunks.close() )
+        while asked: # the tail went out already, this just waits for the last answers
+            if not await confirm(*asked.popleft()):
+                return False
+
+        trace['encode'] = trace.get('encode', 0.0) + encode
+        trace['transmit'] = trace.get('transmit', 0.0) + time.perf_counter() - started - encode
+        trace['bands'] = job.bands
+        if job.stops:
+            trace['stops'] = job.stops
+        finish_job_trace(trace)
+        return True
+
+    def status_dict(self):
+        ' for /status '
+        st = {
+            "selector":      self.selector,
+            "printer_found": (self.device is not None),
+            "connected":     self.connected,
+        }
+        if self.status is not None:
+            st.update(self.status.as_dict())
+        if self.device is not None:
+            st["printer_address"] = self.device.address
+            st["printer_name"] = self.device.name
+        st["queue_len_cmd"] = len(self.command_queue)
+        st["queue_len_prep"] = len(self.preparing_jobs)
+        st["stopped"] = self.command_queue[0].stopped  if self.command_queue  and  isinstance(self.command_queue[0], StreamedPrint)  else  None
+        st["jobs_done"] = self.jobs_done
+        st["lastcomm_agosec"] = round( time.time() - self.last_communication, 1)
+        st["transfer_bytes"] = self.transfer_stats["bytes"]
+        st["transfer_last_bytes_per_sec"] = self.transfer_stats["last_bytes_per_sec"]
+        st["connected_how"] = self.connect_stats["how"]
+        st["connect_sec"] = self.connect_stats["connect_sec"]
+        st["first_print_sec"] = self.connect_stats["first_print_sec"]
+        return st
+
+    async def prepare(self, job, model, trace):
+        """ What happens to a job taken off the queue before it can be sent, none of it in the bluetooth loop itself.
+            Returns (its job_cache key, (what to send, {stage:seconds})) like prepare_job - or what job_cache has, which skips all the work.
+            The key gets worked out in a thread too, since it hashes all of an upload, however large.
+            Compiled jobs just get their files mapped, in a thread (a process could not hand that back), and have no key.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            if job[0] == 'compiled':
+                return None, await loop.run_in_executor(None, load_compiled_job, job[1], model)
+            key = await loop.run_in_executor(None, job_cache_key, *job, model)
+            cached = job_cache.get(key)
+            if cached is not None: # (still waits its turn in preparing_jobs)
+                trace['cached'] = True
+                return key, (cached, {})
+            return key, await loop.run_in_executor(get_job_executor(), prepare_job, *job)
+        finally:
+            release_job_data(job[1])
+            job_queue.wake()
+
+    async def run(self):
+        ' infinitely loop "find our printer and connect to it; while connected, handle queues" '
+        global bluetooth_on
+        loop = asyncio.get_running_loop()
+
+        while 1:
+            #print('while loop')
+            try:
+                self.device = await self.transport.connect()
+                bluetooth_on = True # (however we got connected: a scan says so too, but a direct or simulated connect does not scan)
+                self.connect_stats["how"] = self.transport.connected_how
+                self.last_communication = time.time()
+                self.connect_stats["connect_sec"] = round(time.time() - self.looking_since, 2)
+                self.connect_stats["first_print_sec"] = None
+                log.info("%r: connected %.2f sec after we started looking (%s)", self, self.connect_stats["connect_sec"], self.connect_stats["how"])
+                connects_total.inc(printer=self.name(), how=self.connect_stats["how"])
+                if len(job_queue) > 0  or  len(self.preparing_jobs) > 0  or  len(self.command_queue) > 0: # someone is waiting on us
+                    self.first_print_from = self.looking_since
+                # okay, we are connected, keep talking to it:
+                async with disconnecting(self.transport):
+                    #print('<client>')
+                    try:
+                        self.flow_xon = asyncio.Event()
+                        self.flow_xon.set()
+                        self.status_asked = self.status_answered = 0
+                        self.band_checks = True
+                        packet_size      = self.transport.packet_size()
+                        without_response = self.transport.can_write_without_response()
+                        log.info("%r: sending %d-byte packets, %s, %s", self, packet_size, transfer_mode, 'without response' if without_response else 'with response')
+
+                        # Set up callback to handle messages from the printer
+                        await self.transport.start_notify(self.notification_handler)
+                        self.connected = True
+                        status_feed.changed()
+
+                        while 1:
+                            try:
+                                # we want to ensure a steady stream of status notification within the scope of a connection
+                                try:
+                                    await self.request_status()
+                                except (asyncio.TimeoutError, ConnectionError) as e:
+                                    log.warning("%r: seem to have lost connection (%s)", self, str(e) or 'no status for %s sec'%status_timeout)
                                     break
-                                await asyncio.sleep(0.01)
-                            if device is None:
-                                break
-                            #print( " got it" )
-
-                            if len(command_queue) > 0: 
-                                # there is an argument to make this a a the while will flush everything we queued before we pick up new things to print 
-                                # but also before another (forced) status update, so there is an argument for flushing only so much of what we have left
-                                data = command_queue.pop(0)
-                                while(data):
-                                    #print("sending data to printer: %r"%data)
-                                    #print( "sending %d bytes to printer"%len(data) )
-                                    # Cut the command stream up into pieces small enough for the printer to handle
-                                    await client.write_gatt_char(PrinterCharacteristic, bytes(data[:packet_length]))
-                                    data = data[packet_length:]
-                                    await asyncio.sleep(0.0001)
-                                    last_communication = time.time()
-                                #await asyncio.sleep(0.01)
-                                continue # ensure that notification is fetched between each command - we could refine this.
-
-                            if len(text_queue) > 0:
-                                print( "Taking text off queue to print" )
-                                text, font_size = text_queue.pop(0)
-                                if text is not None:
-                                    print('text:',text)
-                                    command_queue.append( image_to_drawcommands( None, feed_amount=-50) )
-                                    command_queue.append( image_to_drawcommands( generate_text_image(text, font_size=font_size), feed_amount=0, energy=17000 ) )
-                                    command_queue.append( image_to_drawcommands( None, feed_amount=60) )
-
-                            elif len(image_queue) > 0:
-                                print( "Taking image off queue to print" )
-                                image, rotate = image_queue.pop(0)
-
-                                if image is not None:
-                                    image = ensure_pilim(image)
-
-                                    if rotate == 'yes': # rotate 90 degrees always
-                                        image = image.rotate(90, expand=True)
-                                    elif rotate == 'long': # rotate 90 degrees if it's wider than it is high
-                                        w,h = image.size
-                                        if w>h:
-                                            image = image.rotate(90, expand=True)
-
-                                    command_queue.append( image_to_drawcommands( None, feed_amount=-50) )
-                                    command_queue.append( image_to_drawcommands( image ) )
-                                    # the idea was that maybe we get status more often if we print in small strips
-                                    #strips = image_strips( image )
-                                    #print(strips)
-                                    #for stripim in reversed( strips ):
-                                    #    command_queue.append( image_to_drawcommands( stripim ) )
-                                    command_queue.append( image_to_drawcommands( None, feed_amount=60) )
-
-
-                            await asyncio.sleep(0.10)
-
-                        except IndexError as ie:
-                            print(ie)
-                            await asyncio.sleep(0)                    
-                except:
-                    traceback.print_exc(file=sys.stdout)
-                #print('</client>')
-
-
-        except Exception as e:
-            print('EEE', str(e) )
-
-            if 'Is Bluetooth turned on' in str(e)  or "No Bluetooth adapters" in str(e): # BleakError
-                # TODO: set "bluetooth missing or disabled" in status? 
-                print("Bluetooth missing or disabled")
-                bluetooth_on = False
-                await asyncio.sleep(2) # allow you to plug one on / turn it on
-
-            elif 'No device named' in str(e): # BleakError
-                print( 'ND',str(e) )
-            elif 'Not connected' in str(e):   # BleakError
-                print( 'NC',str(e) )
-                #device = None # TODO: check that that doesn't break anything
+
+                                if len(self.command_queue) > 0: 
+                                    # entries are iterables of bytes-like chunks (often generators still encoding the rest).
+                                    # Stop-and-wait sends one and then goes back to fetch a status notification.
+                                    # Pipelined sends everything that is queued back to back, slowed down by XOff/XOn and pipeline_window
+                                    # A StreamedPrint stays first until it is all printed: when it stopped on a problem, we check back every status_interval
+                                    while len(self.command_queue) > 0:
+                                        if isinstance(self.command_queue[0], StreamedPrint):
+                                            if self.command_queue[0].problem(self.status)  or  not await self.send_streamed(self.command_queue[0], packet_size, without_response):
+                                                status_feed.changed()
+                                                await asyncio.sleep(status_interval)
+                                                break
+                                            self.command_queue.pop(0)
+                                        else:
+                                            await self.send_commands(self.command_queue.pop(0), packet_size, without_response)
+                                        if self.first_print_from is not None:
+                                            self.connect_stats["first_print_sec"] = round(time.time() - self.first_print_from, 2)
+                                            self.first_print_from = None
+                                            log.info("%r: first print %.2f sec after we started looking for the printer", self, self.connect_stats["first_print_sec"])
+                                        if transfer_mode != 'pipelined':
+                                            break
+                                    if len(self.command_queue) == 0:
+                                        job_queue.wake() # we're less busy now, which may mean we (or another printer) should take a job
+                                    continue
+
+                                # jobs are prepared in the job executor, so that the bluetooth side (including status) never waits on image work.
+                                # Once the oldest is done, queue its commands: 
+                                # either what we had in job_cache, or encoded while sending (which is cheap), and remembered in job_cache.
+                                if len(self.preparing_jobs) > 0  and  self.preparing_jobs[0][1].done():
+                                    kind, job, trace = self.preparing_jobs.pop(0)
+                                    try:
+                                        key, (prepared, times) = job.result()
+                                    except Exception:
+                                        log.exception( "%r: failed to prepare %s job, skipping it", self, kind )
+                                        jobs_total.inc(kind=kind, outcome='failed')
+                                        job_queue.done( trace['job'], *trace.get('coalesced', ()) )
+                                        status_feed.job(trace, 'failed')
+                                    else:
+                                        trace.update(times)
+                                        if isinstance(prepared, list): # CompiledJobs
+                                            trace['energy'] = max( job.energy  for job in prepared )
+                                            self.command_queue.extend( compiled_entries(prepared, trace) )
+                                            self.jobs_done += 1
+                                            continue
+                                        self.command_queue.append( drawcommand_bands( None, feed_amount=-50) )
+                                        if isinstance(prepared, bytes):
+                                            self.command_queue.append( traced([prepared], trace) )
+                                        elif prepared is not None  and  stream_rows is not None  and  prepared.height >= stream_rows:
+                                            self.command_queue.append( StreamedPrint(prepared, trace, self.device.name) )
+                                        else:
+                                            self.command_queue.append( traced(cache_while_sending(key, drawcommand_bands( prepared, energy=trace['energy'], model=self.device.name )), trace) )
+                                        self.command_queue.append( drawcommand_bands( None, feed_amount=60) )
+                                        self.jobs_done += 1
+                                        continue
+
+                                if len(self.preparing_jobs) < job_workers:
+                                    popped = job_queue.pop(self.accepts)
+                                    if popped is not None:
+                                        job, waited, job_id = popped
+                                        trace = {'job':job_id, 'kind':job[0], 'printer':self.name(), 'queue_wait':waited}
+                                        coalesce = 0  if job[0] == 'compiled'  else  coalesce_jobs-1 # (those are sent as they are)
+                                        more = list( itertools.islice( iter(lambda: job_queue.pop(self.accepts, batch_kinds), None), max(0, coalesce) ) )
+                                        if more: # print them all in one go
+                                            job = batch_of( [job] + [ more_job  for more_job, _, _ in more ] )
+                                            trace.update( kind='batch', coalesced=[ more_id  for _, _, more_id in more ] )
+                                        trace['energy'] = job_energy(*job[:2])
+                                        log.info( "%r: taking %s job %d off queue to print", self, job[0], trace['job'] )
+                                        if job[0] == 'text':
+                                            log.debug('text: %r', job[1])
+                                        prepared = loop.create_task( self.prepare(job, self.device.name, trace) )
+                                        self.preparing_jobs.append( (job[0], prepared, trace) )
+                                        status_feed.job(trace, 'preparing')
+                                        continue
+
+                                # nothing to do right now: sleep until a job gets submitted or prepared, or it's time to check on the printer
+                                await job_queue.wait(status_interval)
+
+                            except IndexError as ie:
+                                log.exception('%r: %s', self, ie)
+                                await asyncio.sleep(0)                    
+                    except Exception:
+                        log.exception("%r: while connected", self)
+                    finally:
+                        connection_lost.inc(printer=self.name())
+                        self.connected = False
+                        status_feed.changed()
+                        self.device = None # next time, look for it again (which first tries connecting to it directly)
+                        self.looking_since = time.time()
+                    #print('</client>')
+
+
+            except Exception as e:
+                if 'Is Bluetooth turned on' in str(e)  or "No Bluetooth adapters" in str(e): # BleakError
+                    # TODO: set "bluetooth missing or disabled" in status? 
+                    log.warning("Bluetooth missing or disabled (%s)", e)
+                    bluetooth_on = False
+                    await asyncio.sleep(2) # allow you to plug one on / turn it on
+
+                elif 'No device named' in str(e): # BleakError
+                    log.info( '%r: %s', self, e )
+                elif 'Not connected' in str(e):   # BleakError
+                    log.warning( '%r: %s', self, e )
+                    #self.device = None # TODO: check that that doesn't break anything
+                else:
+                    log.exception( '%r: %s', self, e )
+
+
+async def connect_catprinters_and_handle_queues():
+    ' run a Printer for each of printer_selectors (or one for whatever accepted printer we find first) '
+    global printer_loop
+    printer_loop = asyncio.get_running_loop()
+    job_queue.bind(printer_loop)
+    if not printers: # (unless someone set them up already, e.g. with their own transports)
+        for selector in (printer_selectors or [None]):
+            printers.append( Printer(selector) )
+    await asyncio.gather( *[ printer.run()  for printer in printers ] )
+
+
+dither_modes = ('floyd-steinberg', 'atkinson', 'bayer', 'threshold')
+
+ImageOptions = collections.namedtuple('ImageOptions', 'rotate dither brightness contrast gamma')
+ImageOptions.__new__.__defaults__ = ('no', 'floyd-steinberg', 1.0, 1.0, 1.0)
+ImageOptions.__doc__ = """ What an image job asks for, besides the image: 
+    rotate is 'no', 'yes', or 'long' (if wider than high),  dither one of dither_modes,  and tone adjustments where 1.0 means unchanged.
+"""
+
+separators = ('dashed', 'line', 'blank')
+
+BatchOptions = collections.namedtuple('BatchOptions', 'separator gap')
+BatchOptions.__new__.__defaults__ = ('dashed', 24)
+BatchOptions.__doc__ = """ How a batch job puts its parts together: gap rows between them, with separator (one of separators) across the middle """
+
+
+@functools.lru_cache(maxsize=64)
+def tone_lut(brightness=1.0, contrast=1.0, gamma=1.0):
+    """ A 256-entry table for Image.point that does brightness and contrast (the same way the CSS filters on our page do), then gamma.
+        gamma above 1 lightens the midtones, which thermal paper tends to need.
+    """
+    lut = []
+    for value in range(256):
+        value = (value*brightness - 128) * contrast + 128
+        value = 255 * (min(255, max(0, value)) / 255) ** (1/gamma)
+        lut.append( round(value) )
+    return lut
+
+
+@functools.lru_cache(maxsize=4)
+def bayer_threshold_image(width, height, order=8):
+    ' an L image with the classic order-by-order ordered-dithering thresholds, tiled to the given size '
+    matrix = [[0]]
+    while len(matrix) < order:
+        matrix = ( [ [4*v   for v in row] + [4*v+2 for v in row]  for row in matrix ] + 
+                   [ [4*v+3 for v in row] + [4*v+1 for v in row]  for row in matrix ] )
+    tile = PIL.Image.new('L', (order, order))
+    tile.putdata([ int( (v + 0.5) * 256 / order**2 )  for row in matrix  for v in row ])
+    strip = PIL.Image.new('L', (width, order))
+    for x in range(0, width, order):
+        strip.paste(tile, (x, 0))
+    ret = PIL.Image.new('L', (width, height))
+    for y in range(0, height, order):
+        ret.paste(strip, (0, y))
+    return ret
+
+
+def atkinson_dither(image):
+    """ Atkinson error diffusion (3/4 of the error goes to six neighbours, which keeps highlights and shadows clean) of an L image.
+
+        Each pixel needs the error from pixels on its left and the two rows above, so rows can't simply be done in bulk.
+        But all pixels on a line x+2y=t only depend on lines before it, so with numpy we go through those lines instead,
+        doing each as a few vector operations:  width+2*height steps, rather than width*height.
+        The pixels are kept skewed, pixel (x, y) at [x+2y, y], so that each line is a plain slice, and so is where its error goes.
+        That is still about 0.1 sec for 384x2000 (floyd-steinberg, which PIL does, takes a few ms).
+        Without numpy this falls back to a (much slower) plain python loop.
+    """
+    w, h = image.size
+    if not have_numpy():
+        return atkinson_dither_python(image)
+    lines = w + 2*h
+    buf = numpy.zeros((lines+4, h+2), numpy.float32) # (the extra lines and columns take the error that spills past the edges)
+    skewed(buf, w, h)[...] = numpy.asarray(image)
+    white = numpy.zeros((lines, h), bool)
+    for t in range(lines - 2):
+        first, last = max(0, (t - w + 2) // 2), min(h, t // 2 + 1)
+        error = buf[t, first:last] # (the values are not needed once looked at, so the error can go right there)
+        on = white[t, first:last]
+        numpy.greater_equal(error, 128, out=on)
+        error -= 255*on
+        error *= 0.125
+        buf[t+1:t+3, first:last]     += error  # (x+1, y) (x+2, y)
+        buf[t+1:t+4, first+1:last+1] += error  # (x-1, y+1) (x, y+1) (x+1, y+1)
+        buf[t+4, first+2:last+2]     += error  # (x, y+2)
+    return PIL.Image.fromarray( numpy.ascontiguousarray(skewed(white, w, h)) ).convert('1')
+
+
+def skewed(array, w, h):
+    ' a writable h x w view of a 2d numpy array, whose [y, x] is array[x + 2*y, y] (see atkinson_dither) '
+    line_stride, stride = array.strides
+    return numpy.lib.stride_tricks.as_strided(array, shape=(h, w), strides=(2*line_stride + stride, line_stride), writeable=True)
+
+
+def atkinson_dither_python(image):
+    ' atkinson_dither without numpy '
+    w, h = image.size
+    pixels = list(image.getdata())
+    rows = [ [float(v) for v in pixels[y*w:(y+1)*w]] + [0.0, 0.0]  for y in range(h) ] + [ [0.0]*(w+2), [0.0]*(w+2) ]
+    out = bytearray(w*h)
+    for y in range(h):
+        row, below, below2 = rows[y], rows[y+1], rows[y+2]
+        for x in range(w):
+            value = row[x]
+            if value >= 128:
+                out[y*w+x] = 255
+                error = (value - 255) * 0.125
             else:
-                traceback.print_exc(file=sys.stdout)
+                error = value * 0.125
+            row[x+1] += error;  row[x+2] += error
+            below[x-1] += error;  below[x] += error;  below[x+1] += error  # (x-1 at x=0 lands in the padding at the end)
+            below2[x] += error
+    return PIL.Image.frombytes('L', (w, h), bytes(out)).convert('1')
+
+
+def dither_image(image, mode='floyd-steinberg'):
+    ' Reduces an image to mode "1", with one of dither_modes '
+    if image.mode == '1':
+        return image
+    if mode == 'floyd-steinberg':
+        return image.convert('1') # PIL's default
+    image = image.convert('L')
+    if mode == 'threshold':
+        return image.point(lambda v: 255 if v >= 128 else 0, '1')
+    if mode == 'bayer':
+        return PIL.ImageChops.subtract(image, bayer_threshold_image(*image.size)).point(lambda v: 255 if v else 0, '1')
+    if mode == 'atkinson':
+        return atkinson_dither(image)
+    raise ValueError('dither should be one of %s'%', '.join(dither_modes))
+
+
+def prepare_image(pil_or_bytes, dither='floyd-steinberg', brightness=1.0, contrast=1.0, gamma=1.0):
+    """ Takes a PIL image or bytes PIL can open; returns a mode "1" image exactly PrinterWidth wide,
+        after tone adjustments (see tone_lut) and dithering (see dither_image).
+        (Doing this again to the result changes nothing, so it's fine to hand prepared images to drawcommand_bands)
+    """
+    # if not PIL image, assume it's bytes that PIL can open
+    pil_image = ensure_pilim( pil_or_bytes )
+
+    # If wider: resize (rotating happens in decode_image)
+    if pil_image.width > PrinterWidth:
+        # image is wider than printer resolution; scale it down proportionately
+        height = int(pil_image.height * (PrinterWidth / pil_image.width))
+        pil_image = pil_image.resize((PrinterWidth, height))
+
+    if pil_image.mode != '1'  and  (brightness, contrast, gamma) != (1.0, 1.0, 1.0):
+        pil_image = pil_image.convert('L').point( tone_lut(brightness, contrast, gamma) )
+
+    # convert image to black-and-white 1bpp color format
+    pil_image = dither_image(pil_image, dither)
+
+    if pil_image.width < PrinterWidth:
+        # image is narrower than printer resolution; pad it out with white pixels
+        padded_image = PIL.Image.new("1", (PrinterWidth, pil_image.height), 1)
+        padded_image.paste(pil_image)
+        pil_image = padded_image
+
+    return pil_image
+
+
+def image_to_rows(pil_image):
+    """ Takes a mode "1" image from prepare_image, returns the bitmap data for all rows, RowBytes per row.
+        PIL packs those MSB-first with a set bit meaning white, the printer wants LSB-first with a set bit meaning ink,
+        so one translate() over the whole buffer does both, instead of a getpixel() per pixel.
+    """
+    return pil_image.tobytes().translate(RowByteTable)
+
+
+CompressedRunPattern = re.compile('0{1,127}|1{1,127}')
+
+def compress_row(row):
+    """ Run-length encodes one row of bitmap data for DrawCompressedBitmap.
+        Returns None when that wouldn't be shorter than the plain row (busy rows, e.g. dithered photos)
+    """
+    pixels = format(int.from_bytes(row, 'little'), '0%db'%PrinterWidth)[::-1] # '1' means ink, leftmost pixel first
+    ret = bytearray()
+    for run in CompressedRunPattern.finditer(pixels):
+        ret.append( (0x80 if pixels[run.start()] == '1' else 0x00)  |  (run.end() - run.start()) )
+        if len(ret) >= RowBytes:
+            return None
+    return bytes(ret)
+
+
+def rows_to_messages(rows, collapse_blank=True, compress=False):
+    """ Takes bitmap data from image_to_rows, returns a bytearray with the messages that print it:
+        a DrawBitmap per row, except that
+        - with collapse_blank, each run of all-white rows becomes a single FeedPaper
+        - with compress, rows become a DrawCompressedBitmap where that is shorter  (only for printers that understand it)
+    """
+    rowcount = len(rows) // RowBytes
+    pieces = [] # each either a [first, last] range of rows to be framed as DrawBitmaps in one go, or a formatted message
+    y = 0
+    while y < rowcount:
+        row = rows[y*RowBytes:(y+1)*RowBytes]
+        if collapse_blank and row == BlankRow:
+            steps = 1
+            while y+steps < rowcount  and  steps < 0xFFFF  and  rows[(y+steps)*RowBytes:(y+steps+1)*RowBytes] == BlankRow:
+                steps += 1
+            pieces.append( format_message(FeedPaper, steps.to_bytes(2, 'little')) )
+            y += steps
+            continue
+        compressed = compress_row(row) if compress else None
+        if compressed is not None:
+            pieces.append( format_message(DrawCompressedBitmap, compressed) )
+        elif pieces and type(pieces[-1]) is list:
+            pieces[-1][1] = y + 1
+        else:
+            pieces.append( [y, y + 1] )
+        y += 1
+
+    # allocate once, then fill
+    framelen = RowBytes + 8
+    ret = bytearray( sum( (p[1]-p[0])*framelen  if type(p) is list  else len(p)  for p in pieces ) )
+    offset = 0
+    for p in pieces:
+        if type(p) is list:
+            format_messages(DrawBitmap, rows[p[0]*RowBytes:p[1]*RowBytes], RowBytes, out=ret, offset=offset)
+            offset += (p[1]-p[0])*framelen
+        else:
+            ret[offset:offset+len(p)] = p
+            offset += len(p)
+    return ret
 
 
-def image_to_drawcommands(pil_or_bytes, feed_amount=0, energy=0x7EE0):
-    " Takes a PIL image, or a bytestring PIL can open -- or None, to only feed "
-    cmdqueue = []
+def drawcommand_bands(pil_or_bytes, feed_amount=0, energy=0x7EE0, model=None, collapse_blank=None, first_band=0):
+    """ Takes a PIL image, or a bytestring PIL can open -- or None, to only feed.
+        Generates the commands that print it, a band of band_height rows at a time,
+        so that sending can start before the rest is encoded, and the whole job's commands never need to be in memory at once.
+        That is a head, a chunk per band, and a tail.
+        model is the printer name, which decides whether we can use DrawCompressedBitmap, and the speed and energy per band (see density_profiles)
+        collapse_blank defaults to the collapse_blank_rows setting
+        first_band skips that many bands (counting in the order they print), to go on with a job that was cut short, see StreamedPrint
+    """
+    if collapse_blank is None:
+        collapse_blank = collapse_blank_rows
     # Ask the printer how it's doing
-    cmdqueue += format_message(GetDevState, [0x00])
+    head  = StatusRequest
     # Set quality to standard
-    cmdqueue += format_message(SetQuality,  [0x33])
+    head += format_message(SetQuality,  [0x33])
     # start and/or set up the lattice, whatever that is
-    cmdqueue += format_message(ControlLattice, PrintLattice)
+    head += format_message(ControlLattice, PrintLattice)
     # Set energy used to a moderate level
-    cmdqueue += format_message(SetEnergy,   [energy.to_bytes(2, 'little')[0], energy.to_bytes(2, 'little')[1]])
+    head += format_message(SetEnergy,   energy.to_bytes(2, 'little'))
     # Set mode to image mode
-    cmdqueue += format_message(DrawingMode, [0])
+    head += format_message(DrawingMode, [0])
     # not entirely sure what this does
-    cmdqueue += format_message(OtherFeedPaper, ImgPrintSpeed)
+    head += format_message(OtherFeedPaper, ImgPrintSpeed)
+    yield head
 
     if pil_or_bytes: # if none this is used to send the wrapping)
-        # if not PIL image, assume it's bytes that PIL can open
-        pil_image = ensure_pilim( pil_or_bytes )
-
-        # If wider: resize (TODO: rotate)
-        if pil_image.width > PrinterWidth:
-            # image is wider than printer resolution; scale it down proportionately
-            height = int(pil_image.height * (PrinterWidth / pil_image.width))
-            pil_image = pil_image.resize((PrinterWidth, height))
-
-        # convert image to black-and-white 1bpp color format
-        pil_image = pil_image.convert("1")
-
-        if pil_image.width < PrinterWidth:
-            # image is narrower than printer resolution; pad it out with white pixels
-            padded_image = PIL.Image.new("1", (PrinterWidth, pil_image.height), 1)
-            padded_image.paste(pil_image)
-            pil_image = padded_image
-
-        #print it so it looks right when spewing out of the mouth
-        pil_image = pil_image.rotate(180) 
-
-        for y in range(0, pil_image.height):
-            bmp = []
-            bit = 0
-            # pack image data into 8 pixels per byte
-            for x in range(0, pil_image.width):
-                if bit % 8 == 0:
-                    bmp += [0x00]
-                bmp[int(bit / 8)] >>= 1
-                if not pil_image.getpixel((x, y)):
-                    bmp[int(bit / 8)] |= 0x80
-                else:
-                    bmp[int(bit / 8)] |= 0
-                bit += 1
-
-            cmdqueue += format_message(DrawBitmap, bmp)
-
+        # resizing and dithering are done on the whole image (dithering per band would show the seams)
+        pil_image = prepare_image(pil_or_bytes)
+        compress = (model in compressed_bitmap_printer_names)
+        profile  = density_profiles.get(model)
+        current  = (ImgPrintSpeed[0], energy) # what the head set
+        # print it so it looks right when spewing out of the mouth, i.e. rotated 180 degrees - so bottom band first, each band rotated
+        for y in range(pil_image.height - first_band*band_height, 0, -band_height):
+            band = pil_image.crop( (0, max(0, y-band_height), PrinterWidth, y) ).transpose(PIL.Image.Transpose.ROTATE_180)
+            rows = image_to_rows(band)
+            messages = rows_to_messages( rows, collapse_blank=collapse_blank, compress=compress )
+            if profile:
+                settings = band_settings(rows, profile, energy)
+                if settings != current: # only say so when it changes
+                    messages[:0] = format_message(SetEnergy, settings[1].to_bytes(2, 'little')) + format_message(OtherFeedPaper, [settings[0]])
+                    current = settings
+            yield messages
+
+    yield drawcommand_tail(feed_amount)
+
+
+def band_settings(rows, profile, energy):
+    """ Takes a band's bitmap data from image_to_rows, an entry from density_profiles, and the job's energy.
+        Returns (speed byte, energy) for the band: per the first profile entry that allows as much ink as the band has.
+    """
+    density = sum( rows.translate(InkCountTable) ) / (8 * max(1, len(rows)))
+    for most, speed, factor in profile:
+        if density <= most:
+            break
+    return speed, min(0xFFFF, round(energy * factor))
+
+
+def drawcommand_tail(feed_amount=0):
+    ' what ends what drawcommand_bands started: feeding (or with a negative feed_amount, retracting) paper, and finishing the lattice '
     # Feed some extra paper after the image
-    cmdqueue += format_message(OtherFeedPaper, BlankSpeed)
+    tail  = format_message(OtherFeedPaper, BlankSpeed)
     if feed_amount > 0:
-        cmdqueue += format_message(FeedPaper,    [feed_amount.to_bytes(2, 'little')[0], feed_amount.to_bytes(2, 'little')[1]])
+        tail += format_message(FeedPaper,    feed_amount.to_bytes(2, 'little'))
     else:
         feed_amount = abs(feed_amount)
-        cmdqueue += format_message(RetractPaper, [feed_amount.to_bytes(2, 'little')[0], feed_amount.to_bytes(2, 'little')[1]])
+        tail += format_message(RetractPaper, feed_amount.to_bytes(2, 'little'))
 
     # iPrint sends another GetDevState request at this point, but we're not staying long enough for an answer
 
     # finish the lattice, whatever that means
-    cmdqueue += format_message(ControlLattice, FinishLattice)
-
-    return cmdqueue
+    tail += format_message(ControlLattice, FinishLattice)
+    return tail
+
+
+def packetize(chunks, size):
+    """ Takes an iterable of bytes-like chunks, generates memoryviews of exactly size bytes (except the last),
+        copying only the few bytes that straddle two chunks. 
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        view = memoryview(chunk)
+        if pending:
+            take = size - len(pending)
+            pending += view[:take]
+            view = view[take:]
+            if len(pending) < size:
+                continue
+            yield memoryview(pending)
+            pending = bytearray()
+        whole = len(view) - len(view) % size
+        for i in range(0, whole, size):
+            yield view[i:i+size]
+        pending = bytearray(view[whole:])
+    if pending:
+        yield memoryview(pending)
+
+
+def iter_drawcommands(pil_or_bytes, packet_size=None, **kwargs):
+    ' Like drawcommand_bands, but generates packet_size-sized memoryviews (default packet_length), which is what the sending loop wants '
+    return packetize( drawcommand_bands(pil_or_bytes, **kwargs), packet_size or packet_length )
+
+
+def image_to_drawcommands(pil_or_bytes, **kwargs):
+    ' Like drawcommand_bands, but returns the whole thing as one bytearray '
+    return bytearray().join( drawcommand_bands(pil_or_bytes, **kwargs) )
+
+
+class CompiledJob:
+    """ A job encoded ahead of time, in a file of its own: a header, then exactly the commands drawcommand_bands made for it.
+        Those depend on the printer model (see compressed_bitmap_printer_names, density_profiles), so a file is for one model.
+        Make them with compile_job (or  python catprint.py compile).  Printing one, or a directory of them in one go (a 'compiled' job, see /print-compiled),
+        sends the commands straight out of the memory-mapped file: nothing gets decoded, dithered, or encoded, or copied into the command queue.
+        (Unlike other jobs, tall ones do not get printed a band at a time, see StreamedPrint)
+    """
+    magic   = b'CATCMDS1'
+    suffix  = '.catjob'
+    header  = struct.Struct('<8s16sHIHQI') # magic, model, width, rows, energy, length of the commands, their crc32
+    trailer = struct.Struct('<I')          # crc32 of the header
+
+    def __init__(self, path, model, width, rows, energy, length, crc):
+        self.path   = path
+        self.model  = model
+        self.width  = width
+        self.rows   = rows
+        self.energy = energy
+        self.length = length
+        self.crc    = crc
+        self.map    = None   # the mmap, once opened
+
+    def __repr__(self):
+        return '<CompiledJob %s, %d rows for %s>'%(self.path, self.rows, self.model)
+
+    def pack_header(self):
+        header = self.header.pack(self.magic, self.model.encode('ascii'), self.width, self.rows, self.energy, self.length, self.crc)
+        return header + self.trailer.pack( zlib.crc32(header) )
+
+    @classmethod
+    def read(cls, path):
+        ' the CompiledJob in the file at path, going by its header (see open).  Raises ValueError if it is not one, or the header is damaged '
+        size = cls.header.size + cls.trailer.size
+        with open(path, 'rb') as f:
+            head = f.read(size)
+        if len(head) < size  or  not head.startswith(cls.magic):
+            raise ValueError('%s is not a compiled job'%path)
+        header, (crc,) = head[:cls.header.size], cls.trailer.unpack(head[cls.header.size:])
+        if zlib.crc32(header) != crc:
+            raise ValueError('%s has a damaged header'%path)
+        _, model, width, rows, energy, length, crc = cls.header.unpack(header)
+        return cls(path, model.rstrip(b'\0').decode('ascii'), width, rows, energy, length, crc)
+
+    def open(self):
+        ' maps the file, and checks that the commands are all there and intact (ValueError if not).  Returns self '
+        offset = self.header.size + self.trailer.size
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != offset + self.length:
+                raise ValueError('%s is %s'%(self.path, 'cut short'  if os.fstat(f.fileno()).st_size < offset + self.length  else  'longer than it should be'))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if zlib.crc32( memoryview(self.map)[offset:] ) != self.crc:
+            raise ValueError('%s is damaged'%self.path)
+        return self
+
+    def chunks(self):
+        ' the commands, as a command_queue entry: one memoryview into the mapped file, which packetize slices without copying '
+        yield memoryview(self.map)[self.header.size + self.trailer.size:]
+
+
+def compile_job(kind, data, option, path, model=None):
+    """ Does all the work of printing a job (see prepare_job) ahead of time, for a printer of model (default: the first of accepted_printer_names),
+        and writes the commands to a job file at path.  Returns its CompiledJob, or None when there is nothing to print (then no file gets written)
+    """
+    model = model or accepted_printer_names[0]
+    prepared, _ = prepare_job(kind, data, option)
+    if prepared is None:
+        return None
+    energy = job_energy(kind, data)
+    length, crc = 0, 0
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.seek( CompiledJob.header.size + CompiledJob.trailer.size )
+        for chunk in drawcommand_bands(prepared, energy=energy, model=model):
+            f.write(chunk)
+            length += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+        job = CompiledJob(path, model, prepared.width, prepared.height, energy, length, crc)
+        f.seek(0)
+        f.write( job.pack_header() )
+    os.replace(tmp, path)
+    return job
+
+
+def compiled_job_paths(path):
+    ' the job file at path, or the job files in the directory at path, in name order '
+    if os.path.isdir(path):
+        return sorted( os.path.join(path, name)  for name in os.listdir(path)  if name.endswith(CompiledJob.suffix) )
+    return [path]
+
+
+def load_compiled_job(path, model):
+    """ What a printer does with a compiled job instead of prepare_job: opens the CompiledJob at path (or each in the directory at path), which have to be for model.
+        Returns a list of them, and {stage:seconds} like prepare_job
+    """
+    t0 = time.perf_counter()
+    jobs = [ CompiledJob.read(job_path)  for job_path in compiled_job_paths(path) ]
+    if not jobs:
+        raise ValueError('%s has no job files'%path)
+    for job in jobs:
+        if job.model != model:
+            raise ValueError('%s was compiled for %s, not %s'%(job.path, job.model, model))
+        job.open()
+    return jobs, {'load': time.perf_counter() - t0}
 
 
 
 ########################### webapp part
 
-app = Flask(__name__)
+# The web API's logic is here, independent of the web framework that serves it:
+# flask (in a thread next to the bluetooth loop), or aiohttp (in the bluetooth loop itself, see start_aiohttp), per web_server.
+# Forms are dicts of field name to value; uploaded images are bytes or a SpooledUpload.
 
-@app.route("/status",      methods=['GET', 'POST'])
-def app_status():
-    ' serve out current status '
+def status_snapshot():
+    """ current status: each printer's under "printers", 
+        and at the top level that of the first connected printer (the page shows that one)
+    """
     st = {
         "bluetooth_on":  bluetooth_on,
-        "printer_found": (device is not None),
+        "printer_found": False,
     }
-    st.update(status)
-    if device is not None:
-        st["printer_address"] = device.address
-        st["printer_name"] = device.name
-    st["queue_len_img"] = len(image_queue)
-    st["queue_len_txt"] = len(text_queue)
-    st["queue_len_cmd"] = len(command_queue)
-    st["lastcomm_agosec"] = round( time.time() - last_communication, 1)
-    print(st) # maybe only if interesting?
-    return jsonify(st)
-
-
-@app.route("/print-text",  methods=['GET', 'POST'])
-def print_text():
+    per_printer = [ printer.status_dict()  for printer in printers ]
+    shown = [ pst  for pst in per_printer  if pst["connected"] ] or per_printer
+    if shown:
+        st.update( shown[0] )
+    counts = job_queue.counts()
+    st["queue_len_img"] = counts['image']
+    st["queue_len_txt"] = counts['text']
+    st["queue_len_batch"] = counts['batch']
+    st["queue_len_compiled"] = counts['compiled']
+    st.update( job_cache.stats() )
+    st["transfer_mode"] = transfer_mode
+    st["printers"] = per_printer
+    return st
+
+
+def metrics_text():
+    ' the same and more, in the Prometheus text format '
+    queued = Counter('catprint_queued_jobs', 'Jobs waiting in the job queue, by kind', type='gauge')
+    counts = job_queue.counts()
+    for kind in ('text', 'image', 'batch', 'compiled'):
+        queued.set( counts[kind], kind=kind )
+    per_printer = Counter('catprint_printer_queue', 'Per printer: jobs being prepared, and command_queue entries waiting to be sent', type='gauge')
+    connected   = Counter('catprint_printer_connected', 'Per printer: whether we are connected to it', type='gauge')
+    for printer in printers:
+        per_printer.set( len(printer.preparing_jobs), printer=printer.name(), queue='preparing' )
+        per_printer.set( len(printer.command_queue),  printer=printer.name(), queue='commands' )
+        connected.set( int(printer.connected), printer=printer.name() )
+    cache = Counter('catprint_job_cache', 'Job cache hits, misses, evictions, entries, bytes', type='gauge')
+    for name, value in job_cache.stats().items():
+        cache.set( value, stat=name[len('cache_'):] )
+    listeners = Counter('catprint_event_listeners', 'Clients listening on /events', type='gauge')
+    listeners.set( len(status_feed.listeners) )
+    lines = []
+    for metric in (job_stage_seconds, ble_write_seconds, status_rtt_seconds, scan_duration, 
+                   ble_bytes, ble_bytes_per_sec, jobs_total, connects_total, connection_lost, scans_total, job_rss_bytes,
+                   queued, per_printer, connected, cache, listeners):
+        lines.extend( metric.exposition() )
+    return '\n'.join(lines)+'\n'
+
+
+def submit_job(job, form):
+    """ queue a job for the printer code to pick up, at the priority the form asked for (urgent, normal, low),
+        and on the printer it asked for, if any (name or MAC address). 
+        Returns (what the HTTP request should respond with, HTTP status)
+    """
+    priority = job_priorities.get( form.get('priority', 'normal') )
+    printer = form.get('printer') or None
+    if priority is None:
+        response = "priority should be one of %s"%', '.join(job_priorities), 400
+    elif printer is not None  and  not any( p.matches(printer)  for p in printers ):
+        response = "no printer %r"%printer, 400
+    else:
+        try:
+            job_queue.submit(job, priority, printer)
+        except asyncio.QueueFull:
+            response = "Printer queue is full, try again later", 429
+        else:
+            status_feed.changed()
+            return "Sent to printer queue", 200
+    release_job_data(job[1])
+    return response
+
+
+def print_text_request(form):
     ' take text (and size), queue for the printer code to pick up '
-    global text_queue
-    text      = request.form.get('text')
-    font_size = int(request.form.get('fontsize', '30'))
-    print(request.args)
-    print('text: %r'%text)
-    print('fontsize: %r'%font_size)
+    text      = form.get('text')
+    font_size = int(form.get('fontsize', '30'))
+    log.debug('print-text: %r, fontsize %r', text, font_size)
     if text is not None:
-        text_queue.append( (text, font_size) )
-        return "Sent to printer queue"
+        return submit_job( ('text', text, font_size), form )
     else:
-        return "no text  :("
+        return "no text  :(", 200
+
+
+def image_options(fields):
+    ' the ImageOptions that fields (a form, or a batch entry) ask for;  raises ValueError saying what is wrong with them '
+    try:
+        options = ImageOptions(
+            rotate     = fields.get('rotate', 'no'),
+            dither     = fields.get('dither', 'floyd-steinberg'),
+            brightness = float(fields.get('brightness', 1.0)),
+            contrast   = float(fields.get('contrast', 1.0)),
+            gamma      = float(fields.get('gamma', 1.0)),
+        )
+    except (ValueError, TypeError):
+        raise ValueError("brightness, contrast, and gamma should be numbers")
+    if options.dither not in dither_modes:
+        raise ValueError("dither should be one of %s"%', '.join(dither_modes))
+    if options.gamma <= 0:
+        raise ValueError("gamma should be more than 0")
+    return options
+
+
+def print_image_request(form):
+    """ take image, queue for the printer code to pick up.
+        Besides imagefile, takes form fields for the ImageOptions: rotate, dither, and brightness, contrast, gamma (1.0 means unchanged)
+    """
+    image = form.get('imagefile')
+    if image is None:
+        return "no image :(", 200
+    try:
+        options = image_options(form)
+    except ValueError as e:
+        release_job_data(image)
+        return str(e), 400
+    log.debug('print-image: %s, %s', image if isinstance(image, SpooledUpload) else '%d bytes'%len(image), options)
+    return submit_job( ('image', image, options), form )
+
+
+def print_batch_request(form):
+    """ take several texts and/or images, queue them as one job that prints in one go (see prepare_batch).
+        The jobs field is a JSON list of {"text":..., "fontsize":...} and {"image": the name of the form field with the file, and ImageOptions fields},
+        separator (one of separators) and gap (rows) go between them.  Uploaded files not mentioned in jobs are ignored.
+    """
+    uploads = [ value  for value in form.values()  if isinstance(value, (bytes, SpooledUpload)) ]
+    try:
+        try:
+            entries = json.loads( form.get('jobs', '') )
+            if not isinstance(entries, list)  or  not all( isinstance(entry, dict)  for entry in entries ):
+                raise ValueError()
+        except ValueError:
+            raise ValueError("jobs should be a JSON list of objects")
+        parts = []
+        for entry in entries:
+            name = entry.get('image')
+            if 'text' in entry:
+                try:
+                    font_size = int(entry.get('fontsize', 30))
+                except (ValueError, TypeError):
+                    raise ValueError("fontsize should be a number")
+                parts.append( ('text', str(entry['text']), font_size) )
+            elif isinstance(name, str)  and  isinstance(form.get(name), (bytes, SpooledUpload)):
+                parts.append( ('image', form[name], image_options(entry)) )
+            else:
+                raise ValueError("each job needs text, or image naming an uploaded file")
+        if not parts:
+            raise ValueError("no jobs")
+        try:
+            option = BatchOptions( form.get('separator', 'dashed'), int(form.get('gap', 24)) )
+        except ValueError:
+            raise ValueError("gap should be a number")
+        if option.separator not in separators:
+            raise ValueError("separator should be one of %s"%', '.join(separators))
+        if not 0 <= option.gap <= 1000:
+            raise ValueError("gap should be 0..1000")
+    except ValueError as e:
+        for upload in uploads:
+            release_job_data(upload)
+        return str(e), 400
+    for upload in uploads:
+        if not any( part[1] is upload  for part in parts ):
+            release_job_data(upload)
+    log.debug('print-batch: %d parts, %s', len(parts), option)
+    return submit_job( ('batch', tuple(parts), option), form )
+
+
+def print_compiled_request(form):
+    """ take a job file made by compile_job (see CompiledJob), or a directory of them, which get queued as one job that prints them in name order.
+        path is relative to compiled_jobs_dir, and has to stay inside it.  The printer that takes one has to be of the model it was compiled for.
+    """
+    root = os.path.realpath(compiled_jobs_dir)
+    path = os.path.realpath( os.path.join(root, form.get('path', '')) )
+    if os.path.commonpath([root, path]) != root:
+        return "path should be inside compiled_jobs_dir", 400
+    if not os.path.exists(path):
+        return "no job file or directory %r"%form.get('path', ''), 404
+    paths = compiled_job_paths(path)
+    if not paths:
+        return "no job files in %r"%form.get('path', ''), 400
+    try:
+        for job_path in paths: # (only the headers, the printer checks the rest)
+            CompiledJob.read(job_path)
+    except (OSError, ValueError) as e:
+        return str(e), 400
+    log.debug('print-compiled: %d job files', len(paths))
+    return submit_job( ('compiled', path, None), form )
+
+
+def app_status():
+    ' serve out current status, see status_snapshot '
+    st = status_snapshot()
+    log.debug('status: %s', st)
+    return flask.jsonify(st)
+
+
+def app_metrics():
+    return flask.Response(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+
+def print_text():
+    return print_text_request(flask.request.form)
+
+
+def flask_form():
+    ' the form of the current request, with uploaded files in it as spool_upload returns them '
+    form = flask.request.form.to_dict()
+    for name, upload in flask.request.files.items():
+        form[name] = spool_upload(upload.stream)
+    return form
 
 
-@app.route("/print-image", methods=['GET', 'POST'])
 def print_image():
-    ' take image, queue for the printer code to pick up '
-    global command_queue
-    imagebytes = request.files.get('imagefile').stream.read()
-    rotate = request.form.get('rotate','no')
-    print('image: %s bytes, rotate:%s'%( len(imagebytes), rotate))
-    if imagebytes is not None:
-        image_queue.append( (imagebytes, rotate) )
-        return "Sent to printer queue"
-    else:
-        return "no image :("
+    return print_image_request( flask_form() )
 
 
-@app.route('/')
-def catch_all():
-    ' index page, shown for all paths except the specific API paths '
-    return """<!DOCTYPE html>
+def print_batch():
+    return print_batch_request( flask_form() )
+
+
+def print_compiled():
+    return print_compiled_request( flask.request.form )
+
+
+index_html = """<!DOCTYPE html>
 <html>
  <head>
     <title>Cat printer</title>
@@ -578,29 +2789,10 @@ function update_from_form() { /* We call this after an interaction to set the ne
 }
 
 
-function update_status() {     /* fetch server status, show useful status things on our page */
+function update_status() {     /* fetch server status, show it */
     fetch("./status")
         .then( function (result) { return result.json() } )
-        .then( function (ob)     { 
-            var s1='', s2='', s3='', s4='';
-            if (!ob.bluetooth_on) {
-                s1 = '<b>bluetooth hardware missing or disabled?</b>';
-            } else if (ob.printer_found && ob.lastcomm_agosec < 3) {
-                s1 = '<b>'+ob.printer_name+' connected</b>';
-                if (ob.lastcomm_agosec>5)                   s1 = '<span style="color:orange">'+s1+'</span>';
-                if (ob.battery_low)                         s2 += ' <span>battery low</span>'; 
-                else if (ob.over_temp)                      s2 += ' <span>over temp</span>'; 
-                else if (ob.cover_open || ob.no_paper)      s2 += ' <span>cover open or no paper</span>'; 
-                if (ob.printing)                            s3 += " <b>...printing...</b>";
-            } else {
-                s1 = '<em>...scanning...<br/><small style="color:#999">('+ob.lastcomm_agosec+' sec, can take 20)</small></em>';
-            }
-            //console.log(s1, s2, s3, s4);
-            document.getElementById('s1').innerHTML = s1;
-            document.getElementById('s2').innerHTML = s2;
-            document.getElementById('s3').innerHTML = s3;
-            document.getElementById('s4').innerHTML = s4;
-        } )
+        .then( show_status )
         .catch(function(error) { // for now assume this is a networkerror because you've stopped that server
             if ( (''+error).includes('NetworkError'))
               document.getElementById('s4').innerHTML = '<span style="color:red">You seem to have stopped the catprint.py server</span>';
@@ -611,6 +2803,29 @@ function update_status() {     /* fetch server status, show useful status things
 }
 
 
+function show_status(ob) {     /* show useful status things on our page */
+    var s1='', s2='', s3='', s4='';
+    if (!ob.bluetooth_on) {
+        s1 = '<b>bluetooth hardware missing or disabled?</b>';
+    } else if (ob.printer_found && ob.lastcomm_agosec < 3) {
+        s1 = '<b>'+ob.printer_name+' connected</b>';
+        if (ob.lastcomm_agosec>5)                   s1 = '<span style="color:orange">'+s1+'</span>';
+        if (ob.battery_low)                         s2 += ' <span>battery low</span>'; 
+        else if (ob.over_temp)                      s2 += ' <span>over temp</span>'; 
+        else if (ob.cover_open || ob.no_paper)      s2 += ' <span>cover open or no paper</span>'; 
+        if (ob.printing)                            s3 += " <b>...printing...</b>";
+        if (ob.stopped)                             s3 += " <b>print stopped, goes on once that is fixed</b>";
+    } else {
+        s1 = '<em>...scanning...<br/><small style="color:#999">('+ob.lastcomm_agosec+' sec, can take 20)</small></em>';
+    }
+    //console.log(s1, s2, s3, s4);
+    document.getElementById('s1').innerHTML = s1;
+    document.getElementById('s2').innerHTML = s2;
+    document.getElementById('s3').innerHTML = s3;
+    document.getElementById('s4').innerHTML = s4;
+}
+
+
 function img_load() {          /* callback for when the image file is set/changed:  makes the browser try to parse it as an image, reset and propagate filter values, show in canvas element */ 
   console.log('img_load', this);
   loaded_image = this;
@@ -709,25 +2924,347 @@ reset_text_values();
 update_sliders();
 update_from_form();
 
-setInterval(update_status, 500);
+var polling = null;
+function poll_status() {       /* ask for the status twice a second */
+    if (polling === null)
+        polling = setInterval(update_status, 500);
+}
+
+/* servers that push status (web_server = 'aiohttp') have /events, with others we poll */
+if (window.EventSource) {
+    var events = new EventSource("./events"), pushed = false;
+    events.addEventListener('status', function (e) { pushed = true;  show_status( JSON.parse(e.data) ); });
+    events.addEventListener('job',    function (e) { console.log('job', JSON.parse(e.data)); });
+    events.onerror = function (e) {
+        if (!pushed) {
+            events.close();
+            poll_status();
+        } else  /* the browser keeps trying to reconnect */
+            document.getElementById('s4').innerHTML = '<span style="color:red">You seem to have stopped the catprint.py server</span>';
+    };
+} else {
+    poll_status();
+}
 </script>
  </body>
 </html>
 """
 
 
-# start web server in thread
-threading.Thread(target=app.run, kwargs={'port':webport, 'debug':False}).start()
+def catch_all():
+    ' index page '
+    return index_html
+
+
+def flask_app():
+    ' the web API as a flask app (importing flask, the first time) '
+    global flask
+    import flask
+    app = flask.Flask(__name__)
+    app.add_url_rule('/status',      view_func=app_status,  methods=['GET', 'POST'])
+    app.add_url_rule('/metrics',     view_func=app_metrics, methods=['GET'])
+    app.add_url_rule('/print-text',  view_func=print_text,  methods=['GET', 'POST'])
+    app.add_url_rule('/print-image', view_func=print_image, methods=['GET', 'POST'])
+    app.add_url_rule('/print-batch', view_func=print_batch, methods=['POST'])
+    app.add_url_rule('/print-compiled', view_func=print_compiled, methods=['POST'])
+    app.add_url_rule('/',            view_func=catch_all)
+    return app
+
+
+def serve_flask(host, port):
+    ' web_server = "flask": serve flask_app() on host:port, from a thread of its own.  Returns the server once it listens '
+    app = flask_app()
+    import werkzeug.serving # (flask's)
+    server = werkzeug.serving.make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='catprint-web', daemon=True).start()
+    log_ready(host, port)
+    return server
+
+
+def web_url(host, port):
+    ' where a browser finds the web API '
+    return 'http://%s:%d'%(host  if host not in ('', '0.0.0.0', '::')  else 'localhost', port)
+
+
+def log_ready(host, port):
+    ' says where the web API is, and how long startup took '
+    log.info('web API on %s, ready %.2f sec after we started (importing took %.2f)', web_url(host, port), time.perf_counter() - import_started, import_seconds)
+
+
+class StatusFeed:
+    """ Pushes changes to whoever listens on /events (only served with web_server = 'aiohttp'), as server-sent events:
+        'status' (what /status answers) when something changed, at most every status_push_min_interval however many listen,
+        and 'job' (its trace so far, plus state) when a job gets taken off the queue, printed, or fails.
+        changed() and job() can be called from any thread, and do nothing until bind()
+    """
+    def __init__(self):
+        self.loop      = None
+        self.dirty     = None
+        self.listeners = set()  # an asyncio.Queue of event text per listener
+
+    def bind(self, loop):
+        ' called from the loop that serves /events '
+        self.loop  = loop
+        self.dirty = asyncio.Event()
+
+    def changed(self):
+        ' something that shows in the status changed '
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.dirty.set)
+
+    def job(self, trace, state):
+        ' a job got to state (preparing, printed, failed, or for a StreamedPrint stopped) '
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.send, 'job', json.dumps( dict(trace, state=state) ))
+            self.changed()
+
+    def send(self, event, data):
+        for queue in list(self.listeners):
+            try:
+                queue.put_nowait( 'event: %s\ndata: %s\n\n'%(event, data) )
+            except asyncio.QueueFull: # a listener that doesn't keep up gets dropped (browsers reconnect by themselves)
+                self.listeners.discard(queue)
+
+    async def listen(self):
+        ' yields the event text to send one listener, starting with the current status, until it falls too far behind '
+        queue = asyncio.Queue(maxsize=100)
+        self.listeners.add(queue)
+        try:
+            yield 'event: status\ndata: %s\n\n'%json.dumps( status_snapshot() )
+            while queue in self.listeners  or  not queue.empty():
+                try:
+                    yield await wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    yield ': still here\n\n' # keeps proxies from closing the connection
+        finally:
+            self.listeners.discard(queue)
+
+    async def run(self):
+        ' turns changes into status events, one snapshot for all listeners (and none when nobody listens) '
+        last = None
+        while 1:
+            try:
+                await wait_for(self.dirty.wait(), status_push_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.dirty.clear()
+            if self.listeners:
+                data = json.dumps( status_snapshot() )
+                if data != last:
+                    self.send('status', data)
+                    last = data
+            await asyncio.sleep(status_push_min_interval)
+
+
+status_feed = StatusFeed()
+
+
+async def spool_part(part):
+    """ Like spool_upload, for an aiohttp multipart part as it streams in: 
+        returns its bytes, or once it is larger than spool_upload_bytes, a SpooledUpload (written from the executor, so the loop never waits on the disk)
+    """
+    head = bytearray()
+    while len(head) <= spool_upload_bytes:
+        chunk = await part.read_chunk(64*1024)
+        if not chunk:
+            return bytes(head)
+        head += chunk
+    loop = asyncio.get_running_loop()
+    fd, path = tempfile.mkstemp(prefix='catprint-', suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            await loop.run_in_executor(None, f.write, head)
+            while 1:
+                chunk = await part.read_chunk(64*1024)
+                if not chunk:
+                    return SpooledUpload(path, f.tell())
+                await loop.run_in_executor(None, f.write, chunk)
+    except BaseException: # e.g. the upload got cut off
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+
+
+async def read_form(request):
+    ' the form of an aiohttp request, as a dict, with uploaded files read by spool_part '
+    form = {}
+    if request.content_type == 'multipart/form-data':
+        async for part in (await request.multipart()):
+            if part.filename is not None  or  part.name == 'imagefile':
+                release_job_data( form.get(part.name) )
+                form[part.name] = await spool_part(part)
+            else:
+                form[part.name] = await part.text()
+    elif request.can_read_body:
+        form.update( await request.post() )
+    return form
 
-# point local browser at that
-import webbrowser
-webbrowser.open('http://localhost:%d'%webport, new=2)
 
-# start the bluetooth communication
-async def main():
-    L = await asyncio.gather(
-        connect_catprinter_and_handle_queues(),
-        #request_printer_status()
-    )
-asyncio.run( main() )
+async def aiohttp_status(request):
+    return aiohttp.web.json_response( status_snapshot() )
+
+
+async def aiohttp_metrics(request):
+    return aiohttp.web.Response( body=metrics_text().encode('utf8'), headers={'Content-Type':'text/plain; version=0.0.4'} )
+
 
+async def aiohttp_print_text(request):
+    form = await read_form(request)
+    text, status = await asyncio.get_running_loop().run_in_executor(None, print_text_request, form) # the journal waits on the disk
+    return aiohttp.web.Response(text=text, status=status)
+
+
+async def aiohttp_print_image(request):
+    form = await read_form(request)
+    text, status = await asyncio.get_running_loop().run_in_executor(None, print_image_request, form)
+    return aiohttp.web.Response(text=text, status=status)
+
+
+async def aiohttp_print_batch(request):
+    form = await read_form(request)
+    text, status = await asyncio.get_running_loop().run_in_executor(None, print_batch_request, form)
+    return aiohttp.web.Response(text=text, status=status)
+
+
+async def aiohttp_print_compiled(request):
+    form = await read_form(request)
+    text, status = await asyncio.get_running_loop().run_in_executor(None, print_compiled_request, form)
+    return aiohttp.web.Response(text=text, status=status)
+
+
+async def aiohttp_events(request):
+    ' server-sent events, see StatusFeed '
+    response = aiohttp.web.StreamResponse( headers={'Content-Type':'text/event-stream', 'Cache-Control':'no-cache'} )
+    await response.prepare(request)
+    events = status_feed.listen()
+    try:
+        async for event in events:
+            await response.write( event.encode('utf8') )
+    except ConnectionError: # they went away
+        pass
+    finally:
+        await events.aclose()
+    return response
+
+
+async def aiohttp_index(request):
+    return aiohttp.web.Response(text=index_html, content_type='text/html')
+
+
+async def start_aiohttp(host, port):
+    """ web_server = "aiohttp": start serving the web API from this event loop, on host:port (importing aiohttp, the first time).
+        Returns the AppRunner, whose cleanup() stops it.  Status only gets pushed to /events while status_feed.run() runs
+    """
+    global aiohttp
+    import aiohttp.web
+    web_app = aiohttp.web.Application()
+    web_app.router.add_route('*',  '/status',      aiohttp_status)
+    web_app.router.add_get(        '/metrics',     aiohttp_metrics)
+    web_app.router.add_route('*',  '/print-text',  aiohttp_print_text)
+    web_app.router.add_route('*',  '/print-image', aiohttp_print_image)
+    web_app.router.add_post(       '/print-batch', aiohttp_print_batch)
+    web_app.router.add_post(       '/print-compiled', aiohttp_print_compiled)
+    web_app.router.add_get(        '/events',      aiohttp_events)
+    web_app.router.add_get(        '/',            aiohttp_index)
+    status_feed.bind( asyncio.get_running_loop() )
+    runner = aiohttp.web.AppRunner(web_app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, host, port).start()
+    log_ready(host, port)
+    return runner
+
+
+# start the bluetooth communication
+async def main(webport=None, webhost=None, browser=False):
+    """ The bluetooth side, and on webport the web API: flask in a thread next to this event loop, or with web_server = "aiohttp" in it.
+        The printers start looking before the web side gets imported (which takes a while).  browser opens a tab on the page once it is up.
+    """
+    webhost = webhost  if webhost is not None  else  web_host
+    loop = asyncio.get_running_loop()
+    tasks = [ asyncio.ensure_future( connect_catprinters_and_handle_queues() ) ]
+    runner = None
+    try:
+        await asyncio.sleep(0) # (lets that start)
+        if webport is not None:
+            if web_server == 'aiohttp':
+                await loop.run_in_executor(None, importlib.import_module, 'aiohttp.web') # rather than have the printers wait while it imports
+                runner = await start_aiohttp(webhost, webport)
+                tasks.append( asyncio.ensure_future( status_feed.run() ) )
+            else:
+                await loop.run_in_executor(None, serve_flask, webhost, webport)
+            if browser:
+                import webbrowser
+                await loop.run_in_executor(None, webbrowser.open, web_url(webhost, webport), 2)
+        await asyncio.gather( *tasks )
+    finally:
+        for task in tasks:
+            task.cancel()
+        if runner is not None:
+            await runner.cleanup()
+
+
+def cli(argv=None):
+    """ what  python catprint.py  does: the printer daemon, with its web API, and a browser tab on that unless --no-browser.
+        Or with the compile command, write a job file for it to print later (see compile_job)
+    """
+    global web_server, printer_transport
+    parser = argparse.ArgumentParser(description='Keeps cat printers connected over bluetooth, and prints what its web page (or API) is given')
+    parser.add_argument('--host',       default=web_host, help='address the web API listens on (default: %(default)s; 0.0.0.0 for all of them)')
+    parser.add_argument('--port',       default=web_port, type=int, help='port the web API listens on (default: a free one)')
+    parser.add_argument('--no-browser', action='store_true', help='do not open a browser tab on the page, e.g. when running as a service')
+    parser.add_argument('--web-server', default=web_server, choices=('flask', 'aiohttp'), help='see web_server (default: %(default)s)')
+    parser.add_argument('--simulated',  action='store_true', help='talk to simulated printers rather than bluetooth ones, see SimulatedPrinter')
+    commands = parser.add_subparsers(dest='command', metavar='compile')
+    compiling = commands.add_parser('compile', help='do the work of printing a text or image ahead of time, into a job file for /print-compiled')
+    compiling.add_argument('output', help='job file to write (best ending in %s, and in compiled_jobs_dir)'%CompiledJob.suffix)
+    what = compiling.add_mutually_exclusive_group(required=True)
+    what.add_argument('--text',      help="text to print ('-' reads it from stdin)")
+    what.add_argument('--image',     metavar='FILE', help='image file to print')
+    compiling.add_argument('--font-size', default=30, type=int, help='for text (default: %(default)s)')
+    compiling.add_argument('--model', default=accepted_printer_names[0], choices=accepted_printer_names, help='printer it is for (default: %(default)s)')
+    for option in ImageOptions._fields:
+        compiling.add_argument('--'+option, help='for images, see ImageOptions')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compile':
+        if args.text is not None:
+            job = ( 'text', sys.stdin.read()  if args.text == '-'  else  args.text, args.font_size )
+        else:
+            try:
+                options = image_options( { option:getattr(args, option)  for option in ImageOptions._fields  if getattr(args, option) is not None } )
+            except ValueError as e:
+                parser.error(str(e))
+            with open(args.image, 'rb') as f:
+                job = ('image', f.read(), options)
+        compiled = compile_job(*job, args.output, args.model)
+        print( '%s: %d rows, %d bytes of commands for %s'%(args.output, compiled.rows, compiled.length, compiled.model)  if compiled  else  'nothing to print' )
+        return
+
+    web_server = args.web_server
+    if args.simulated:
+        printer_transport = 'simulated'
+
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)-7s %(message)s')
+    if logging.getLogger().getEffectiveLevel() > logging.DEBUG: # the web servers log every request at INFO, e.g. each open page's /status twice a second
+        for web_logger in ('werkzeug', 'aiohttp.access'):
+            logging.getLogger(web_logger).setLevel(logging.WARNING)
+    if job_trace_file:
+        trace_handler = logging.FileHandler(job_trace_file)
+        trace_handler.setFormatter( logging.Formatter('%(message)s') )
+        trace_log.addHandler(trace_handler)
+        trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False # only in job_trace_file, not mixed in with the rest
+
+    if web_server == 'aiohttp'  and  importlib.util.find_spec('aiohttp') is None:
+        raise SystemExit("web_server = 'aiohttp' needs aiohttp installed")
+
+    if job_journal_file:
+        job_queue.open_journal(job_journal_file)
+
+    asyncio.run( main(args.port  if args.port is not None  else  find_free_port(),  args.host,  browser=not args.no_browser) )
+
+
+import_seconds = time.perf_counter() - import_started
+
+if __name__ == '__main__':
+    cli()